@@ -1,62 +1,294 @@
-from twisted.internet import task
+from twisted.internet import reactor, task
 from twisted.internet.defer import Deferred
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ClientFactory, Factory, ReconnectingClientFactory
 from twisted.protocols.basic import LineReceiver
 
 import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
 
 import DHT_server
 
+from kivy.logger import Logger
 
-class EchoClient(LineReceiver):
-    end = "Bye-bye!"
+SERVER_BANNER = "DHT22 server"
+SUBSCRIBE_REQUEST = "Send me data"
+
+# Binary framing is asked for by adding BINARY_FRAMING to the subscribe request. A server that supports it
+# adds the same word to its banner and switches to frames; any other banner means JSON lines as before.
+BINARY_FRAMING = "binary"
+
+# Frame: magic, number of records, then the records back to back
+FRAME_HEADER = struct.Struct('<HH')
+FRAME_MAGIC = 0x4844
+# Record: sensor id, time, temperature, humidity
+FRAME_RECORD = struct.Struct('<Hdff')
+MAX_RECORDS_PER_FRAME = 0xffff
+
+# Reconnect backoff, in seconds
+INITIAL_DELAY = 1.0
+MAX_DELAY = 60.0
+
+_reactor_thread = None
+
+
+def encode_frame(records):
+    """records is a list of (sensor id, time, temperature, humidity)"""
+    return FRAME_HEADER.pack(FRAME_MAGIC, len(records)) + ''.join([FRAME_RECORD.pack(*r) for r in records])
+
+
+class FrameDecoder:
+    """Reassembles binary frames from a byte stream"""
 
     def __init__(self):
-        self.temperature = None
-        self.humidity = None
+        self.buffer = ''
+
+    def feed(self, data):
+        """Returns the records of every frame completed by data"""
+        self.buffer += data
+        records = []
+        offset = 0
+
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            (magic, count) = FRAME_HEADER.unpack_from(self.buffer, offset)
+
+            if magic != FRAME_MAGIC:
+                raise ValueError("Bad frame header")
+
+            end = offset + FRAME_HEADER.size + count * FRAME_RECORD.size
+
+            if end > len(self.buffer):
+                # Rest of the frame hasn't arrived yet
+                break
+
+            for i in range(offset + FRAME_HEADER.size, end, FRAME_RECORD.size):
+                records.append(FRAME_RECORD.unpack_from(self.buffer, i))
+
+            offset = end
+
+        self.buffer = self.buffer[offset:]
+
+        return records
+
+
+class DHTClient(LineReceiver):
+    """Subscribes to a DHT22 server and hands every reading to the factory's sensor"""
 
     def connectionMade(self):
-        self.sendLine("Send me data")
+        Logger.info("DHT22: Connected to %s" % self.transport.getPeer().host)
+
+        # Connected, so start the backoff from scratch next time we lose it
+        self.factory.resetDelay()
+
+        self.decoder = None
+
+        if self.factory.binary:
+            self.sendLine("%s %s" % (SUBSCRIBE_REQUEST, BINARY_FRAMING))
+        else:
+            self.sendLine(SUBSCRIBE_REQUEST)
 
     def lineReceived(self, line):
-        if "DHT22 server" == line:
+        if "%s %s" % (SERVER_BANNER, BINARY_FRAMING) == line:
+            self.decoder = FrameDecoder()
+            self.setRawMode()
             return
 
-        print line
+        if SERVER_BANNER == line:
+            return
 
-        (temp, humidity) = json.loads(line)
+        try:
+            (temp, humidity) = json.loads(line)
+        except ValueError:
+            Logger.warning("DHT22: Could not decode %s" % line)
+            return
 
-        print "received: %.1f C, %.1f humidity" % (temp, humidity)
+        self.factory.sensor.update_reading(temp, humidity)
 
-        if line == self.end:
+    def rawDataReceived(self, data):
+        try:
+            records = self.decoder.feed(data)
+        except ValueError:
+            Logger.warning("DHT22: Lost frame sync, reconnecting")
             self.transport.loseConnection()
+            return
 
+        sensor_id = self.factory.sensor_id
 
+        for (record_id, reading_time, temp, humidity) in records:
+            if sensor_id is None or sensor_id == record_id:
+                self.factory.sensor.update_reading(temp, humidity, reading_time)
 
-class EchoClientFactory(ClientFactory):
-    protocol = EchoClient
 
-    def __init__(self):
-        self.done = Deferred()
+class DHTClientFactory(ReconnectingClientFactory):
+    """Keeps a single connection to the DHT22 server open, reconnecting with exponential backoff"""
+    protocol = DHTClient
 
+    initialDelay = INITIAL_DELAY
+    maxDelay = MAX_DELAY
 
-    def clientConnectionFailed(self, connector, reason):
-        print('connection failed:', reason.getErrorMessage())
-        self.done.errback(reason)
+    def __init__(self, sensor, binary=False, sensor_id=None):
+        self.sensor = sensor
+        self.binary = binary
+        self.sensor_id = sensor_id
 
+    def clientConnectionFailed(self, connector, reason):
+        Logger.warning("DHT22: Connection failed: %s" % reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
     def clientConnectionLost(self, connector, reason):
-        print('connection lost:', reason.getErrorMessage())
-        self.done.callback(None)
+        Logger.warning("DHT22: Connection lost: %s" % reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+
+def subscribe(sensor, host, port=DHT_server.TWISTED_PORT, binary=False, sensor_id=None):
+    """Streams readings from the DHT22 server at host into sensor.update_reading().
+
+    binary asks the server for binary frames, falling back to JSON lines if it doesn't support them. With
+    binary frames, sensor_id picks out one sensor's readings from a server that sends several.
+
+    Runs the twisted reactor in a background thread, so this can be called from a Kivy or pygame app."""
+    global _reactor_thread
+
+    factory = DHTClientFactory(sensor, binary, sensor_id)
+
+    if _reactor_thread is None:
+        reactor.connectTCP(host, port, factory)
+
+        _reactor_thread = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False})
+        _reactor_thread.daemon = True
+        _reactor_thread.start()
+    else:
+        reactor.callFromThread(reactor.connectTCP, host, port, factory)
+
+    return factory
+
+
+class StubServer(LineReceiver):
+    """Stands in for the DHT22 server when testing: sends made up readings every interval seconds, batch
+    of them at a time"""
+
+    def connectionMade(self):
+        self.sender = None
+        self.binary = False
+
+    def lineReceived(self, line):
+        if line == "%s %s" % (SUBSCRIBE_REQUEST, BINARY_FRAMING) and self.factory.binary:
+            self.binary = True
+            self.sendLine("%s %s" % (SERVER_BANNER, BINARY_FRAMING))
+        elif line.startswith(SUBSCRIBE_REQUEST):
+            self.sendLine(SERVER_BANNER)
+        else:
+            return
+
+        if self.factory.count is not None:
+            self.send_readings(self.factory.count)
+            return
+
+        self.sender = task.LoopingCall(self.send_readings, self.factory.batch)
+        self.sender.start(self.factory.interval)
+
+    def send_readings(self, count):
+        readings = [(i % 4, time.time(), round(random.uniform(18, 24), 1), round(random.uniform(35, 60), 1))
+                    for i in range(count)]
+
+        if self.binary:
+            for start in range(0, count, MAX_RECORDS_PER_FRAME):
+                self.transport.write(encode_frame(readings[start:start + MAX_RECORDS_PER_FRAME]))
+        else:
+            self.transport.write(''.join([json.dumps(r[2:]) + self.delimiter for r in readings]))
+
+    def connectionLost(self, reason):
+        if self.sender is not None and self.sender.running:
+            self.sender.stop()
+
+
+class StubServerFactory(Factory):
+    """count sends that many readings straight away instead of a batch every interval"""
+    protocol = StubServer
+
+    def __init__(self, interval=1.0, batch=1, binary=True, count=None):
+        self.interval = interval
+        self.batch = batch
+        self.binary = binary
+        self.count = count
+
+
+class PrintingSensor:
+    def update_reading(self, temperature, humidity, reading_time=None):
+        print "received: %.1f C, %.1f humidity" % (temperature, humidity)
+
+
+class CountingSensor:
+    """Fires done once count readings have arrived"""
+
+    def __init__(self, count):
+        self.count = count
+        self.received = 0
+        self.done = Deferred()
+
+    def update_reading(self, temperature, humidity, reading_time=None):
+        self.received += 1
+
+        if self.received == self.count:
+            self.done.callback(None)
+
+
+class BenchmarkClientFactory(ClientFactory):
+    protocol = DHTClient
+
+    def __init__(self, sensor, binary):
+        self.sensor = sensor
+        self.binary = binary
+        self.sensor_id = None
+
+    def resetDelay(self):
+        pass
+
+
+def benchmark(reactor, count=100000):
+    """Times streaming count readings from a local stub server, with JSON lines and with binary frames"""
+    port = reactor.listenTCP(0, StubServerFactory(count=count), interface='127.0.0.1')
+    address = port.getHost()
+    results = Deferred()
+
+    def run(binary):
+        sensor = CountingSensor(count)
+        start = (time.time(), sum(os.times()[:2]))
+        reactor.connectTCP(address.host, address.port, BenchmarkClientFactory(sensor, binary))
+
+        def finished(_):
+            elapsed = time.time() - start[0]
+            cpu = sum(os.times()[:2]) - start[1]
+            print "%-6s %d readings in %.2fs (%.0f readings/s), %.2fs CPU" % (
+                'binary' if binary else 'json', count, elapsed, count / elapsed, cpu)
+
+        return sensor.done.addCallback(finished)
+
+    d = run(False)
+    d.addCallback(lambda _: run(True))
+    d.addCallback(lambda _: port.stopListening())
+    d.chainDeferred(results)
+
+    return results
 
 
+def main(reactor, host='localpi', *args):
+    if host == 'stub':
+        reactor.listenTCP(DHT_server.TWISTED_PORT, StubServerFactory())
+    elif host == 'benchmark':
+        return benchmark(reactor, *[int(a) for a in args])
+    else:
+        binary = BINARY_FRAMING in args
+        reactor.connectTCP(host, DHT_server.TWISTED_PORT, DHTClientFactory(PrintingSensor(), binary))
 
-def main(reactor):
-    factory = EchoClientFactory()
-    reactor.connectTCP('localpi', DHT_server.TWISTED_PORT, factory)
-    return factory.done
+    # Run until interrupted
+    return Deferred()
 
 
 
 if __name__ == '__main__':
-    task.react(main)
\ No newline at end of file
+    task.react(main, sys.argv[1:])
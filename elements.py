@@ -3,6 +3,7 @@ import pygame.gfxdraw
 import time
 import syslog
 import math
+import collections
 
 from kivy.logger import Logger
 
@@ -15,7 +16,8 @@ element_types = [['DateTime', 'DateTimeElementClass'],
                  ['Icons', 'IconElementClass'],
                  ['Forecast', 'ForecastElementClass'],
                  ['Almanac', 'AlmanacElementClass'],
-                 ['DHT11', 'DHT11ElementClass']]
+                 ['DHT11', 'DHT11ElementClass'],
+                 ['Graph', 'GraphElementClass']]
 
 class elementClass:
     """Superclass. Must provide a render() function"""
@@ -255,6 +257,10 @@ class lifxButonClass(pygameButtonClass):
 
         self.show_offline_icon = False
 
+        # Power and colour come from the shared light states, so nothing here waits for a bulb. A change
+        # makes the next update_condition() show it.
+        self.light.subscribe(self._light_changed)
+
         self._update_colour(self.light.power())
         self.render()
 
@@ -268,6 +274,9 @@ class lifxButonClass(pygameButtonClass):
             self.last_updated = time.time()
         pass
 
+    def _light_changed(self):
+        self.last_updated = None
+
     def render(self):
         # Capture zero length background colour lists
         if type(self.back_colour) is list:
@@ -389,13 +398,18 @@ class ConditionElementClass(elementClass):
         self.text = None
 
     def update_condition(self, weather_underground, sun_almanac, indoor_sensor):
-        try:
-            self.text = self.text_format % weather_underground.conditions[self.element_name]
-        except KeyError:
+        if self.element_name in weather_underground.conditions:
+            condition = weather_underground.conditions[self.element_name]
+        elif self.element_name in weather_underground.derived:
+            # e.g. pressure_tendency_3h, worked out from logged history
+            condition = weather_underground.derived[self.element_name]
+        else:
             Logger.warning("Could not find condition element [%s]" % self.element_name)
             self.text = "Err"
             return
 
+        self.text = self.text_format % condition
+
     def render(self):
         self.surface = self.font.render(self.text, True, self.colour)
 
@@ -407,7 +421,8 @@ class DHT11ElementClass(elementClass):
         self.text = None
 
     def update_condition(self, weather_underground, sun_almanac, indoor_sensor):
-        reading = getattr(indoor_sensor, self.element_name)
+        # Element names are sensor.channel, or just channel for the default sensor
+        reading = indoor_sensor.reading(self.element_name)
 
         if reading is None:
             syslog.syslog(syslog.LOG_DEBUG, "indoor_sensor element [%s] in None" % self.element_name)
@@ -423,3 +438,97 @@ class DHT11ElementClass(elementClass):
 
     def render(self):
         self.surface = self.font.render(self.text, True, self.colour)
+
+class GraphElementClass(elementClass):
+    """Plots a field from the history database over the last window seconds.
+
+    The series is downsampled to about points buckets and cached; each update only fetches the buckets from
+    the newest cached one onwards, and the plot is only redrawn when the series changes."""
+    def __init__(self, conf_settings, element_name, background_colour):
+        elementClass.__init__(self, conf_settings, element_name, background_colour)
+
+        self.field = self.element_settings.get('field', element_name)
+        self.window = int(self.element_settings.get('window', 86400))
+        self.points = int(self.element_settings.get('points', self.size[0]))
+
+        self.database = utils.shared_database(conf_settings.main['Database'])
+        self.database.check_fields([self.field])
+
+        # Long windows come from a rollup table, short ones from history averaged over step seconds
+        self.period = self.database.rollup_period(0, self.window, self.points)
+        self.step = self.period if self.period is not None else max(self.window // self.points, 1)
+
+        self.series = collections.deque()       # (bucket start, value), oldest first
+        self.dirty = True
+
+        self.surface = pygame.Surface(self.size)
+
+    def blank_surface(self):
+        pass    # The plot covers the whole surface and is only redrawn when the series changes
+
+    def update_condition(self, weather_underground, sun_almanac, indoor_sensor):
+        if not self.updateDue():
+            return
+
+        now = time.time()
+        self.last_updated = now
+
+        # Refetch from the newest bucket, which may have had more readings added since
+        if self.series:
+            start = self.series[-1][0]
+        else:
+            start = now - self.window
+
+        if self.period is None:
+            (times, values) = self.database.query(['datetime', self.field], start, now + 1, step=self.step)
+        else:
+            (times, values) = self.database.query_period(['datetime', self.field], start, now + 1, self.period)
+
+        new_tail = [(t, v) for (t, v) in zip(times, values) if v is not None]
+
+        old_tail = []
+        while self.series and self.series[-1][0] >= start:
+            old_tail.insert(0, self.series.pop())
+
+        self.series.extend(new_tail)
+
+        while self.series and self.series[0][0] < now - self.window - self.step:
+            self.series.popleft()
+            self.dirty = True
+
+        if new_tail != old_tail:
+            self.dirty = True
+
+    def render(self):
+        if not self.dirty:
+            return
+
+        self.dirty = False
+        self.surface.fill(self.background_colour)
+
+        if len(self.series) < 2:
+            return
+
+        values = [v for (t, v) in self.series]
+        low = min(values)
+        high = max(values)
+
+        if high == low:
+            (low, high) = (low - 1, high + 1)
+
+        (width, height) = self.size
+        end = self.series[-1][0]
+        time_span = float(max(end - self.series[0][0], 1))
+
+        points = []
+        for (t, v) in self.series:
+            x = int((width - 1) * (1 - (end - t) / time_span))
+            y = int((height - 1) * (high - v) / (high - low))
+            points.append((x, y))
+
+        pygame.draw.aalines(self.surface, self.colour, False, points)
+
+        if self.font is not None:
+            self.surface.blit(self.font.render("%.1f" % high, True, self.colour), (0, 0))
+            label = self.font.render("%.1f" % low, True, self.colour)
+            self.surface.blit(label, (0, height - label.get_height()))
@@ -0,0 +1,188 @@
+"""Exports sensor history from the weather database, a chunk at a time so memory use stays flat however much
+history there is.
+
+    python export.py --format csv --fields datetime,temp --start 2016-01-01 history.csv
+    python export.py --format columnar history.bin
+"""
+
+import argparse
+import array
+import csv
+import datetime
+import os
+import struct
+import sys
+import time
+
+import configobj
+
+import history
+
+SETTINGS_FILE = os.path.dirname(os.path.abspath(__file__)) + "/weather.conf"
+
+EXPORT_CHUNK = 4096
+
+# Columnar file: header, then blocks of up to EXPORT_CHUNK rows. Each block is its row count followed by
+# each field's values as little endian doubles, one field after another. A block of 0 rows ends the file.
+COLUMNAR_MAGIC = 'WPIC'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sHH')        # magic, version, number of fields
+COLUMNAR_BLOCK = struct.Struct('<I')            # rows in block
+
+
+def export_csv(database, out, fields, start=None, end=None, iso_dates=False):
+    """Writes a header line and then a line per reading. Returns the number of readings written"""
+    writer = csv.writer(out)
+    writer.writerow(fields)
+
+    time_index = fields.index('datetime') if (iso_dates and 'datetime' in fields) else None
+    count = 0
+
+    for rows in database.query_chunks(fields, start, end, chunk_size=EXPORT_CHUNK):
+        if time_index is not None:
+            rows = [_iso_row(row, time_index) for row in rows]
+
+        writer.writerows(rows)
+        count += len(rows)
+
+    return count
+
+
+def export_columnar(database, out, fields, start=None, end=None):
+    """Writes the compact binary columnar format. Returns the number of readings written"""
+    out.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(fields)))
+
+    for field in fields:
+        out.write(struct.pack('<B', len(field)) + field)
+
+    nan = float('nan')
+    count = 0
+
+    for rows in database.query_chunks(fields, start, end, chunk_size=EXPORT_CHUNK):
+        out.write(COLUMNAR_BLOCK.pack(len(rows)))
+
+        for values in zip(*rows):
+            column = array.array('d', [nan if v is None else v for v in values])
+
+            if sys.byteorder == 'big':
+                column.byteswap()
+
+            out.write(column.tostring())
+
+        count += len(rows)
+
+    out.write(COLUMNAR_BLOCK.pack(0))
+
+    return count
+
+
+def read_columnar(f):
+    """Generates (fields, columns) for each block of a columnar file, columns being array.array('d')s"""
+    (magic, version, field_count) = COLUMNAR_HEADER.unpack(f.read(COLUMNAR_HEADER.size))
+
+    if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+        raise ValueError("Not a version %d columnar export" % COLUMNAR_VERSION)
+
+    fields = []
+    for i in range(field_count):
+        length = struct.unpack('<B', f.read(1))[0]
+        fields.append(f.read(length))
+
+    while True:
+        rows = COLUMNAR_BLOCK.unpack(f.read(COLUMNAR_BLOCK.size))[0]
+
+        if rows == 0:
+            return
+
+        columns = []
+        for field in fields:
+            column = array.array('d')
+            column.fromstring(f.read(rows * column.itemsize))
+
+            if sys.byteorder == 'big':
+                column.byteswap()
+
+            columns.append(column)
+
+        yield fields, columns
+
+
+def _iso_row(row, time_index):
+    row = list(row)
+
+    if row[time_index] is not None:
+        row[time_index] = datetime.datetime.fromtimestamp(row[time_index]).isoformat()
+
+    return row
+
+
+def _parse_time(text):
+    """Seconds since the epoch, given either that or a local YYYY-MM-DD[THH:MM] date"""
+    if text is None:
+        return None
+
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    for time_format in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, time_format))
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError("Cannot understand time %s" % text)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Export sensor history from the weather database")
+    parser.add_argument('output', help="File to write, - for standard output")
+    parser.add_argument('--format', choices=['csv', 'columnar'], default='csv')
+    parser.add_argument('--fields', help="Comma separated fields to export, all of them by default")
+    parser.add_argument('--start', type=_parse_time, help="Earliest reading, as a date or seconds since the epoch")
+    parser.add_argument('--end', type=_parse_time, help="Export readings before this time")
+    parser.add_argument('--iso-dates', action='store_true', help="Write CSV times as ISO 8601 dates")
+    parser.add_argument('--database', help="Database file, by default the one in weather.conf")
+    options = parser.parse_args(args)
+
+    filename = options.database
+    if filename is None:
+        filename = configobj.ConfigObj(SETTINGS_FILE)['Database']['filename']
+
+    if not os.path.isfile(filename):
+        parser.error("Cannot find database %s" % filename)
+
+    database = history.Database({'filename': filename}, read_only=True)
+
+    if options.fields is None:
+        fields = [name for (name, column_type) in database.schema]
+    else:
+        fields = options.fields.split(',')
+
+    try:
+        database.check_fields(fields)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if options.output == '-':
+        out = sys.stdout
+    else:
+        out = open(options.output, 'wb')
+
+    try:
+        if options.format == 'csv':
+            count = export_csv(database, out, fields, options.start, options.end, options.iso_dates)
+        else:
+            count = export_columnar(database, out, fields, options.start, options.end)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+        database.close()
+
+    sys.stderr.write("Exported %d readings\n" % count)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
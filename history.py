@@ -0,0 +1,599 @@
+"""Sensor history, kept in an sqlite database"""
+
+import Queue
+import array
+import atexit
+import collections
+import sqlite3
+import syslog
+import threading
+import time
+
+import trends
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Database():
+    """Readings are queued by write_reading() and written by a background thread in batched transactions, once
+    batch_size readings are waiting or flush_interval seconds after the first of them arrived. The database
+    runs in WAL mode so that commits don't each cost a full fsync of the SD card."""
+
+    _CLOSE = object()
+    QUERY_CHUNK = 256
+
+    # Retention housekeeping, done by the writer thread when it's idle
+    MAINTENANCE_INTERVAL = 600      # Seconds between passes once caught up
+    PRUNE_PAUSE = 1                 # Seconds between passes while there's a backlog to delete
+    PRUNE_BATCH = 500               # Rows deleted from each table per pass
+    VACUUM_PAGES = 100              # Free pages handed back to the filesystem per pass
+
+    # Aggregate tables kept up to date as readings are written, as (table, bucket length in seconds),
+    # coarsest first. Buckets are aligned to UTC.
+    ROLLUPS = [('history_daily', 86400),
+               ('history_hourly', 3600)]
+
+    TREND_FIELDS = ['datetime', 'temp', 'pressure', 'humidity']
+    TREND_CHECK_INTERVAL = 60       # Seconds between looks for readings logged by another process
+
+    def __init__(self, database_settings, read_only=False):
+        """With read_only, only the query methods can be used. Nothing is written to the file, so it can be a
+        read-only copy and is left as it is: no schema changes, rollups, trends or writer thread."""
+        if 'update' in database_settings:
+            self.update_interval = int(database_settings['update'])
+        else:
+            self.update_interval = None
+
+        self.batch_size = int(database_settings.get('batch_size', 10))
+        self.flush_interval = int(database_settings.get('flush_interval', 300))
+        self.synchronous = database_settings.get('synchronous', 'NORMAL')
+
+        # How long to keep each table, e.g. raw_days = 30, hourly_days = 365, daily_days = 3650. Kept forever
+        # if not set.
+        self.retention = []
+        for (key, table, time_column) in [('raw_days', 'history', 'datetime'),
+                                          ('hourly_days', 'history_hourly', 'bucket'),
+                                          ('daily_days', 'history_daily', 'bucket')]:
+            if key in database_settings:
+                self.retention.append((table, time_column, float(database_settings[key])))
+
+        # Databases created before retention existed don't hand free pages back. Converting them takes a full
+        # VACUUM, which locks the database for a long time and needs about its size again in free space, so
+        # it's only done if asked for with convert_vacuum = true. Otherwise pruned pages are reused for new
+        # rows, which still stops the file growing.
+        self.convert_vacuum = str(database_settings.get('convert_vacuum', False)).lower() in ('true', 'yes', 'on', '1')
+
+        self.last_updated = None
+        self.writer_thread = None
+
+        self.filename = database_settings['filename']
+        self.db = sqlite3.connect(self.filename)
+
+        self.schema = [['datetime',     'REAL'],
+                       ['temp',         'REAL'],
+                       ['pressure',     'REAL'],
+                       ['humidity',     'REAL'],
+                       ['temp_raw',     'REAL'],
+                       ['humidity_raw', 'REAL']]
+
+        if read_only:
+            self.db.execute("PRAGMA query_only=ON")
+            self.cursor = self.db.cursor()
+
+            # Files from older versions may be missing some of the columns
+            self.cursor.execute("PRAGMA table_info(history)")
+            columns = [row[1] for row in self.cursor.fetchall()]
+            self.schema = [[name, column_type] for (name, column_type) in self.schema if name in columns]
+            return
+
+        # Only takes effect on a brand new database, see _maintain() for existing ones
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._configure_connection(self.db)
+
+        self.cursor = self.db.cursor()
+
+        # Do we need to create a new table?
+        try:
+            self.cursor.execute("SELECT * from history LIMIT 1")
+        except sqlite3.OperationalError:
+            self.cursor.execute("CREATE TABLE history(%s)" % self._create_table_text())
+            self.db.commit()
+            syslog.syslog(syslog.LOG_INFO, "Created new data table in database %s" % database_settings['filename'])
+
+        self._add_missing_columns()
+
+        # Range queries all select on time
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS history_datetime ON history(datetime)")
+        self.db.commit()
+
+        self._create_rollups()
+
+        # Seed the rolling windows so trends are available straight after a restart
+        self.trends = trends.Trends()
+        self.trends_until = time.time() - max([seconds for (suffix, seconds) in trends.WINDOWS])
+        self.trends_checked = 0
+        self._read_trends()
+
+        self.queue = Queue.Queue()
+        self.writer_thread = threading.Thread(target=self._writer, args=())
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+        atexit.register(self.close)
+
+    def log_reading(self, weather_underground, indoor_sensor):
+        data_dict = {}
+
+        data_dict['humidity'] = indoor_sensor.humidity
+        data_dict['temp'] = indoor_sensor.temperature
+        data_dict['humidity_raw'] = indoor_sensor.raw_humidity
+        data_dict['temp_raw'] = indoor_sensor.raw_temperature
+        data_dict['pressure'] = weather_underground.conditions['pressure_mb']
+
+        self.write_reading(data_dict)
+        self.last_updated = time.time()
+
+        self.trends.add_reading(data_dict)
+        self.trends_until = max(self.trends_until, data_dict['datetime'])
+
+    def trend_conditions(self):
+        """Trends.conditions() for everything logged so far. Readings logged by another process, such as
+        weather.py logging while weatherpi.py displays, are picked up every TREND_CHECK_INTERVAL seconds."""
+        if time.time() - self.trends_checked >= self.TREND_CHECK_INTERVAL:
+            self._read_trends()
+
+        return self.trends.conditions()
+
+    def _read_trends(self):
+        """Adds readings logged after trends_until to the trends"""
+        self.trends_checked = time.time()
+
+        for row in self.query_range(self.TREND_FIELDS, start=self.trends_until):
+            if row[0] > self.trends_until:
+                self.trends.add_reading(dict(zip(self.TREND_FIELDS, row)))
+                self.trends_until = row[0]
+
+    def write_reading(self, data_dict):
+        """Queues reading to be saved to the database.
+        Expects a dictionary in the format {'datetime': 12345678, 'level': float value,
+                                             'station': "Abingdon Lock', 'stream': "upstream"} """
+
+        # Time specified?
+        if not self._time_specified(data_dict):
+            data_dict['datetime'] = int(time.time())
+
+        self.queue.put(data_dict)
+
+    def flush(self):
+        """Writes out any queued readings, returning once they're committed"""
+        if self.writer_thread is None or not self.writer_thread.is_alive():
+            return
+
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Writes out any queued readings, stops the writer thread and closes the database"""
+        if self.writer_thread is not None and self.writer_thread.is_alive():
+            self.queue.put(self._CLOSE)
+            self.writer_thread.join()
+
+        self.db.close()
+
+    def _writer(self):
+        db = sqlite3.connect(self.filename)
+        self._configure_connection(db)
+
+        pending = []
+        deadline = None
+        next_maintenance = time.time() if self.retention else None
+
+        while True:
+            wake_times = [t for t in (deadline, next_maintenance) if t is not None]
+
+            try:
+                if not wake_times:
+                    item = self.queue.get()
+                else:
+                    item = self.queue.get(True, max(min(wake_times) - time.time(), 0))
+            except Queue.Empty:
+                item = None
+
+            if isinstance(item, dict):
+                pending.append(item)
+
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+
+                if len(pending) < self.batch_size:
+                    continue
+
+            if pending and (item is not None or time.time() >= deadline):
+                try:
+                    self._write_batch(db, pending)
+                    pending = []
+                except sqlite3.Error as e:
+                    syslog.syslog(syslog.LOG_ERR, "Database write failed: %s" % e)
+
+                    if len(pending) > self.batch_size * 10:
+                        # Give up rather than queue forever
+                        pending = []
+
+                deadline = None if not pending else time.time() + self.flush_interval
+
+            if item is self._CLOSE:
+                break
+
+            if item is not None and not isinstance(item, dict):
+                # flush() is waiting for us
+                item.set()
+
+            if item is None and next_maintenance is not None and time.time() >= next_maintenance:
+                next_maintenance = time.time() + self._maintain(db)
+
+        db.close()
+
+    def _maintain(self, db):
+        """Deletes a small batch of rows past their retention time from each table and gives some free pages
+        back to the filesystem, so no single pass blocks writes for long. Returns seconds until the next pass."""
+        backlog = False
+
+        try:
+            if self.convert_vacuum and db.execute("PRAGMA auto_vacuum").fetchone()[0] == 0:
+                syslog.syslog(syslog.LOG_INFO, "Converting %s to incremental vacuum" % self.filename)
+                db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                db.execute("VACUUM")
+
+            now = time.time()
+
+            with db:
+                for (table, time_column, days) in self.retention:
+                    deleted = db.execute("DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s WHERE %s < ? LIMIT ?)" % (
+                        table, table, time_column), (now - days * 86400, self.PRUNE_BATCH)).rowcount
+
+                    if deleted == self.PRUNE_BATCH:
+                        backlog = True
+
+            # Each result row is a freed page, so step through them all
+            db.execute("PRAGMA incremental_vacuum(%d)" % self.VACUUM_PAGES).fetchall()
+        except sqlite3.Error as e:
+            syslog.syslog(syslog.LOG_ERR, "Database maintenance failed: %s" % e)
+
+        if backlog:
+            return self.PRUNE_PAUSE
+
+        return self.MAINTENANCE_INTERVAL
+
+    def _write_batch(self, db, readings):
+        # Readings with the same fields share one statement
+        statements = collections.OrderedDict()
+
+        for data_dict in readings:
+            fields = tuple(data_dict.keys())
+            statements.setdefault(fields, []).append(tuple(data_dict.values()))
+
+        with db:
+            for fields, rows in statements.items():
+                value_list = ('?,'*len(fields))[:-1]
+                sql_string = "INSERT into history (%s) VALUES (%s)" % (', '.join(fields), value_list)
+
+                db.executemany(sql_string, rows)
+
+            self._update_rollups(db, readings)
+
+        syslog.syslog(syslog.LOG_DEBUG, "Wrote %d readings to database (%d to %d)" % (
+            len(readings), readings[0]['datetime'], readings[-1]['datetime']))
+
+    def _configure_connection(self, db):
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=%s" % self.synchronous)
+
+    def updateDue(self):
+        if self.last_updated is None:
+            return True
+
+        if self.update_interval is not None:
+            if (time.time() - self.update_interval) > self.last_updated:
+                return True
+
+        return False
+
+    def query(self, fields, start=None, end=None, limit=None, step=None):
+        """Fields = list of fields to be returned by query, e.g. ['datetime', 'temp']
+
+        Optionally limited to a time range, see query_range()
+
+        returns a list in format: [[1234, 1235, ...], [26.1, 26.2, ...]]
+        """
+        query_list = [[] for field in fields]
+
+        for row in self.query_range(fields, start, end, limit, step):
+            for i in range(len(fields)):
+                query_list[i].append(row[i])
+
+        return query_list
+
+    def query_columns(self, fields, start=None, end=None, limit=None, step=None):
+        """Like query(), but each column comes back as a contiguous buffer of doubles rather than a list:
+        a NumPy array if NumPy is installed, otherwise an array.array('d'). Missing values are NaN."""
+        columns = [array.array('d') for field in fields]
+        nan = float('nan')
+
+        for chunk in self.query_chunks(fields, start, end, limit, step):
+            # Transpose the chunk in one go and extend each column from the resulting tuple
+            for column, values in zip(columns, zip(*chunk)):
+                if None in values:
+                    values = [nan if v is None else v for v in values]
+
+                column.extend(values)
+
+        if numpy is not None:
+            # Shares the array's memory rather than copying it
+            return [numpy.frombuffer(column, dtype=numpy.float64) for column in columns]
+
+        return columns
+
+    def query_range(self, fields, start=None, end=None, limit=None, step=None):
+        """Generates rows of fields, oldest first, for readings with start <= datetime < end.
+
+        With step, readings are averaged over step second buckets and datetime is the start of each bucket.
+        Rows are fetched from the cursor QUERY_CHUNK at a time, so memory use doesn't grow with the range."""
+        for rows in self.query_chunks(fields, start, end, limit, step):
+            for row in rows:
+                yield row
+
+    def query_chunks(self, fields, start=None, end=None, limit=None, step=None, chunk_size=None):
+        """Generates the rows of query_range() in lists of up to chunk_size (default QUERY_CHUNK) rows"""
+        self.check_fields(fields)
+
+        conditions = []
+
+        if start is not None:
+            conditions.append("datetime >= :start")
+
+        if end is not None:
+            conditions.append("datetime < :end")
+
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        if step is None:
+            sql_string = "SELECT %s FROM history%s ORDER BY datetime" % (', '.join(fields), where)
+        else:
+            bucket = "CAST(datetime / :step AS INTEGER)"
+            columns = []
+
+            for field in fields:
+                if field == 'datetime':
+                    columns.append("%s * :step" % bucket)
+                else:
+                    columns.append("AVG(%s)" % field)
+
+            sql_string = "SELECT %s FROM history%s GROUP BY %s ORDER BY %s" % (', '.join(columns), where, bucket, bucket)
+
+        if limit is not None:
+            sql_string += " LIMIT :limit"
+
+        parameters = {'start': start, 'end': end, 'limit': limit, 'step': step}
+
+        return self._execute_chunks(sql_string, parameters, chunk_size)
+
+    def _execute_chunks(self, sql_string, parameters, chunk_size=None):
+        """Generates lists of up to chunk_size result rows"""
+        if chunk_size is None:
+            chunk_size = self.QUERY_CHUNK
+
+        cursor = self.db.cursor()
+        cursor.execute(sql_string, parameters)
+
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+
+                if not rows:
+                    break
+
+                yield rows
+        finally:
+            cursor.close()
+
+    def query_rollup(self, fields, start, end, points=100):
+        """Returns columns like query() for start <= datetime < end, read from the coarsest of the rollup
+        tables that still gives at least points buckets across the range, or from history if none does.
+
+        Fields can be datetime (the start of each bucket), a field name for its mean, or the field name
+        followed by _min, _max or _count."""
+        return self.query_period(fields, start, end, self.rollup_period(start, end, points))
+
+    def query_period(self, fields, start, end, period):
+        """query_rollup() for a given rollup period, or raw history if period is None"""
+        table = 'history'
+        columns = []
+
+        for (table_name, table_period) in self.ROLLUPS:
+            if table_period == period:
+                table = table_name
+
+        for field in fields:
+            (name, statistic) = self._split_rollup_field(field)
+
+            if period is None:
+                if statistic == 'count':
+                    columns.append("CASE WHEN %s IS NULL THEN 0 ELSE 1 END" % name)
+                else:
+                    columns.append(name)
+            else:
+                if name == 'datetime':
+                    columns.append("bucket")
+                elif statistic is None:
+                    columns.append("%s_sum / %s_count" % (name, name))
+                else:
+                    columns.append(field)
+
+        time_column = 'datetime' if period is None else 'bucket'
+        sql_string = "SELECT %s FROM %s WHERE %s >= :start AND %s < :end ORDER BY %s" % (
+            ', '.join(columns), table, time_column, time_column, time_column)
+
+        query_list = [[] for field in fields]
+
+        for rows in self._execute_chunks(sql_string, {'start': start, 'end': end}):
+            for row in rows:
+                for i in range(len(fields)):
+                    query_list[i].append(row[i])
+
+        return query_list
+
+    def rollup_period(self, start, end, points):
+        """Bucket length of the coarsest rollup with at least points buckets between start and end, None
+        if only raw readings will do"""
+        for (table, period) in self.ROLLUPS:
+            if (end - start) / period >= points:
+                return period
+
+        return None
+
+    def _split_rollup_field(self, field):
+        for statistic in ('min', 'max', 'count'):
+            if field.endswith('_' + statistic) and field[:-len(statistic) - 1] in self._rollup_fields():
+                return field[:-len(statistic) - 1], statistic
+
+        self.check_fields([field])
+
+        return field, None
+
+    def _rollup_fields(self):
+        return [name for (name, column_type) in self.schema if name != 'datetime']
+
+    def _rollup_columns(self):
+        columns = []
+
+        for name in self._rollup_fields():
+            columns += [['%s_min' % name, 'REAL'],
+                        ['%s_max' % name, 'REAL'],
+                        ['%s_sum' % name, 'REAL'],
+                        ['%s_count' % name, 'INTEGER']]
+
+        return columns
+
+    def _create_rollups(self):
+        for (table, period) in self.ROLLUPS:
+            try:
+                self.cursor.execute("SELECT * from %s LIMIT 1" % table)
+            except sqlite3.OperationalError:
+                self.cursor.execute("CREATE TABLE %s(bucket INTEGER PRIMARY KEY, %s)" % (
+                    table, ', '.join(["%s %s" % (name, column_type) for (name, column_type) in self._rollup_columns()])))
+
+                # One off scan to cover readings logged before the rollups existed
+                aggregates = []
+                for name in self._rollup_fields():
+                    aggregates.append("MIN(%s), MAX(%s), SUM(%s), COUNT(%s)" % (name, name, name, name))
+
+                self.cursor.execute("INSERT INTO %s SELECT CAST(datetime / %d AS INTEGER) * %d, %s FROM history "
+                                    "GROUP BY 1" % (table, period, period, ', '.join(aggregates)))
+                self.db.commit()
+
+                syslog.syslog(syslog.LOG_INFO, "Created rollup table %s" % table)
+
+            self._add_missing_columns(table, self._rollup_columns())
+
+    def _update_rollups(self, db, readings):
+        """Folds readings into the rollup tables, without rescanning history"""
+        fields = self._rollup_fields()
+
+        for (table, period) in self.ROLLUPS:
+            buckets = collections.OrderedDict()
+
+            # Combine the batch first, so each bucket only gets one UPDATE
+            for data_dict in readings:
+                bucket = int(data_dict['datetime'] // period) * period
+                statistics = buckets.setdefault(bucket, {})
+
+                for (name, value) in data_dict.items():
+                    if name not in fields or value is None:
+                        continue
+
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        continue
+
+                    if name in statistics:
+                        (low, high, total, count) = statistics[name]
+                        statistics[name] = (min(low, value), max(high, value), total + value, count + 1)
+                    else:
+                        statistics[name] = (value, value, value, 1)
+
+            for (bucket, statistics) in buckets.items():
+                if not statistics:
+                    continue
+
+                db.execute("INSERT OR IGNORE INTO %s (bucket) VALUES (?)" % table, (bucket,))
+
+                assignments = []
+                parameters = []
+
+                for (name, (low, high, total, count)) in statistics.items():
+                    assignments.append("%(f)s_min = MIN(COALESCE(%(f)s_min, ?), ?), "
+                                       "%(f)s_max = MAX(COALESCE(%(f)s_max, ?), ?), "
+                                       "%(f)s_sum = COALESCE(%(f)s_sum, 0) + ?, "
+                                       "%(f)s_count = COALESCE(%(f)s_count, 0) + ?" % {'f': name})
+                    parameters += [low, low, high, high, total, count]
+
+                db.execute("UPDATE %s SET %s WHERE bucket = ?" % (table, ', '.join(assignments)),
+                           parameters + [bucket])
+
+    def check_fields(self, fields):
+        """Field names go straight into the SQL, so only allow the ones in the schema"""
+        names = [name for (name, column_type) in self.schema]
+
+        for field in fields:
+            if field not in names:
+                raise ValueError("Unknown database field %s" % field)
+
+    def _time_specified(self, data_dict):
+        if 'datetime' in data_dict:
+            if data_dict['datetime'] is not None:
+                return True
+
+        return False
+
+    def _add_missing_columns(self, table='history', schema=None):
+        """Brings tables created by older versions up to date with the schema"""
+        if schema is None:
+            schema = self.schema
+
+        self.cursor.execute("PRAGMA table_info(%s)" % table)
+        columns = [row[1] for row in self.cursor.fetchall()]
+
+        for (name, column_type) in schema:
+            if name not in columns:
+                self.cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, column_type))
+                syslog.syslog(syslog.LOG_INFO, "Added column %s to %s table" % (name, table))
+
+        self.db.commit()
+
+    def _create_table_text(self):
+        text = ""
+
+        for i in range(0, len(self.schema)):
+            if i > 0:
+                text = text + ", "
+
+            text = text + "%s %s" % (self.schema[i][0], self.schema[i][1])
+
+        return text
+
+
+_databases = {}
+
+def shared_database(database_settings):
+    """One Database per file, shared between the logger and anything that charts its history"""
+    filename = database_settings['filename']
+
+    if filename not in _databases:
+        _databases[filename] = Database(database_settings)
+
+    return _databases[filename]
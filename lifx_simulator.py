@@ -0,0 +1,337 @@
+"""Simulates LIFX bulbs on this machine, speaking enough of the LIFX LAN protocol for lifxlan to discover them,
+read their labels, groups, power and colour, and switch them. Each bulb gets its own UDP port; latency, packet
+loss and offline bulbs can be set, so polling can be sized for big installations without owning the bulbs.
+
+    python lifx_simulator.py serve --bulbs 50 --latency 0.02 --loss 0.05 --offline 0.1
+    python lifx_simulator.py benchmark --bulbs 10,50,200 --latency 0.02
+
+serve listens for discovery on port 56700 of --host, so lifxlan on the LAN finds the bulbs when --host is ''.
+benchmark runs its own simulator on 127.0.0.1 and points lifxlan at it.
+"""
+
+import argparse
+import hashlib
+import heapq
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+import lifxlan
+
+import utils
+
+LIFX_PORT = 56700
+
+# Header: size, protocol and flags, source, target, reserved, response flags, sequence, reserved, type, reserved
+HEADER = struct.Struct('<HHI8s6sBBQHH')
+PROTOCOL = 1024
+ADDRESSABLE = 0x1000
+ACK_REQUIRED = 0x02
+RES_REQUIRED = 0x01
+
+# Message types
+GET_SERVICE = 2
+STATE_SERVICE = 3
+GET_HOST_FIRMWARE = 14
+STATE_HOST_FIRMWARE = 15
+GET_POWER = 20
+SET_POWER = 21
+STATE_POWER = 22
+GET_LABEL = 23
+SET_LABEL = 24
+STATE_LABEL = 25
+GET_VERSION = 32
+STATE_VERSION = 33
+ACKNOWLEDGEMENT = 45
+GET_LOCATION = 48
+STATE_LOCATION = 50
+GET_GROUP = 51
+STATE_GROUP = 53
+LIGHT_GET = 101
+LIGHT_SET_COLOR = 102
+LIGHT_STATE = 107
+LIGHT_GET_POWER = 116
+LIGHT_SET_POWER = 117
+LIGHT_STATE_POWER = 118
+
+# LIFX A19, so lifxlan treats the bulbs as plain colour lights
+VENDOR = 1
+PRODUCT = 27
+
+BROADCAST_TARGET = '\0' * 8
+
+
+class SimulatedBulb(object):
+    def __init__(self, mac, label, group, power=0, color=(0, 0, 65535, 3500), online=True):
+        self.mac = mac
+        self.target = ''.join([chr(int(part, 16)) for part in mac.split(':')]) + '\0\0'
+        self.label = label
+        self.group = group
+        self.location = 'Home'
+        self.power = power
+        self.color = list(color)
+        self.online = online
+
+        self.sock = None
+
+    def handle(self, message_type, payload):
+        """Applies a message, returning (reply type, reply payload), or None if it doesn't have a reply"""
+        if message_type in (SET_POWER, LIGHT_SET_POWER):
+            self.power = struct.unpack_from('<H', payload)[0]
+        elif message_type == SET_LABEL:
+            self.label = payload[:32].rstrip('\0')
+        elif message_type == LIGHT_SET_COLOR:
+            self.color = list(struct.unpack_from('<4H', payload, 1))
+
+        if message_type in (GET_POWER, SET_POWER):
+            return STATE_POWER, struct.pack('<H', self.power)
+
+        if message_type in (LIGHT_GET_POWER, LIGHT_SET_POWER):
+            return LIGHT_STATE_POWER, struct.pack('<H', self.power)
+
+        if message_type in (GET_LABEL, SET_LABEL):
+            return STATE_LABEL, struct.pack('32s', self.label)
+
+        if message_type in (LIGHT_GET, LIGHT_SET_COLOR):
+            return LIGHT_STATE, struct.pack('<4HhH32sQ', *(self.color + [0, self.power, self.label, 0]))
+
+        if message_type == GET_GROUP:
+            return STATE_GROUP, struct.pack('<16s32sQ', hashlib.md5(self.group).digest(), self.group, 0)
+
+        if message_type == GET_LOCATION:
+            return STATE_LOCATION, struct.pack('<16s32sQ', hashlib.md5(self.location).digest(), self.location, 0)
+
+        if message_type == GET_VERSION:
+            return STATE_VERSION, struct.pack('<III', VENDOR, PRODUCT, 0)
+
+        if message_type == GET_HOST_FIRMWARE:
+            return STATE_HOST_FIRMWARE, struct.pack('<QQI', 0, 0, (2 << 16) | 80)
+
+        return None
+
+
+class Simulator(object):
+    """Answers for every bulb from one thread. Replies are held back by latency seconds plus up to jitter
+    more, and loss is the chance of any packet, in or out, going missing. Offline bulbs never answer."""
+
+    def __init__(self, bulbs, host='127.0.0.1', port=LIFX_PORT, latency=0.0, jitter=0.0, loss=0.0):
+        self.bulbs = bulbs
+        self.host = host
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+
+        # Discovery broadcasts come in here; each bulb answers from its own socket
+        self.discovery = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.discovery.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.discovery.bind((host, port))
+        self.port = self.discovery.getsockname()[1]
+
+        self.by_socket = {}
+
+        for bulb in bulbs:
+            bulb.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            bulb.sock.bind((host, 0))
+            self.by_socket[bulb.sock] = bulb
+
+        # (time due, sequence, socket, data, address)
+        self.replies = []
+        self.reply_count = 0
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+        self.discovery.close()
+        for bulb in self.bulbs:
+            bulb.sock.close()
+
+    def point_lifxlan(self):
+        """Sends lifxlan's discovery broadcasts to this simulator instead of the LAN"""
+        discovery_module = sys.modules[lifxlan.LifxLAN.__module__]
+        discovery_module.UDP_BROADCAST_IP_ADDRS = [self.host]
+        discovery_module.UDP_BROADCAST_PORT = self.port
+
+    def run(self):
+        sockets = [self.discovery] + self.by_socket.keys()
+
+        while self.running:
+            now = time.time()
+
+            while self.replies and self.replies[0][0] <= now:
+                (due, sequence, sock, data, address) = heapq.heappop(self.replies)
+                sock.sendto(data, address)
+
+            timeout = 0.1
+            if self.replies:
+                timeout = min(timeout, max(0, self.replies[0][0] - now))
+
+            (readable, writable, errors) = select.select(sockets, [], [], timeout)
+
+            for sock in readable:
+                (data, address) = sock.recvfrom(1024)
+
+                if sock is self.discovery:
+                    self.receive(self.bulbs, data, address)
+                else:
+                    self.receive([self.by_socket[sock]], data, address)
+
+    def receive(self, bulbs, data, address):
+        if len(data) < HEADER.size or self.lost():
+            return
+
+        (size, protocol, source, target, reserved, flags, sequence, reserved, message_type, reserved) = \
+            HEADER.unpack_from(data)
+        payload = data[HEADER.size:size]
+
+        for bulb in bulbs:
+            if not bulb.online or target not in (BROADCAST_TARGET, bulb.target):
+                continue
+
+            if message_type == GET_SERVICE:
+                self.reply(bulb, address, source, sequence, STATE_SERVICE,
+                           struct.pack('<BI', 1, bulb.sock.getsockname()[1]))
+                continue
+
+            reply = bulb.handle(message_type, payload)
+
+            if flags & ACK_REQUIRED:
+                self.reply(bulb, address, source, sequence, ACKNOWLEDGEMENT, '')
+
+            # Gets always answer; sets only when asked to
+            if reply is not None and (flags & RES_REQUIRED or not flags & ACK_REQUIRED):
+                self.reply(bulb, address, source, sequence, *reply)
+
+    def reply(self, bulb, address, source, sequence, message_type, payload):
+        if self.lost():
+            return
+
+        data = HEADER.pack(HEADER.size + len(payload), PROTOCOL | ADDRESSABLE, source, bulb.target, '\0' * 6, 0,
+                           sequence, 0, message_type, 0) + payload
+
+        self.reply_count += 1
+        due = time.time() + self.latency + random.uniform(0, self.jitter)
+
+        heapq.heappush(self.replies, (due, self.reply_count, bulb.sock, data, address))
+
+    def lost(self):
+        return self.loss > 0 and random.random() < self.loss
+
+
+def make_bulbs(count, rooms=None, offline=0.0, on=0.5):
+    """count bulbs spread over rooms rooms (one per four bulbs by default), with a fraction offline and
+    a fraction on"""
+    if rooms is None:
+        rooms = max(1, count // 4)
+
+    bulbs = []
+
+    for i in range(count):
+        mac = 'd0:73:d5:%02x:%02x:%02x' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        bulbs.append(SimulatedBulb(mac, 'Bulb %d' % (i + 1), 'Room %d' % (i % rooms + 1),
+                                   power=65535 if random.random() < on else 0,
+                                   online=random.random() >= offline))
+
+    return bulbs
+
+
+def benchmark(counts, latency=0.0, jitter=0.0, loss=0.0, offline=0.0):
+    """Times discovery and a full state refresh for each number of bulbs, one light at a time as the Lights
+    screen used to and all at once through utils.LifxStates. Every bulb answers discovery; the offline
+    fraction stop answering before the refreshes, as bulbs switched off at the wall would."""
+    print "%6s %8s %12s %8s %12s %8s %12s %12s" % ('bulbs', 'found', 'discovery', 'labelled', 'with labels',
+                                                    'offline', 'serial poll', 'shared poll')
+
+    for count in counts:
+        bulbs = make_bulbs(count)
+        simulator = Simulator(bulbs, port=0, latency=latency, jitter=jitter, loss=loss).start()
+        simulator.point_lifxlan()
+
+        try:
+            start = time.time()
+            try:
+                lights = len(lifxlan.LifxLAN().get_lights())
+            except lifxlan.WorkflowException:
+                # A bulb stopped answering part way through, which loses the whole discovery
+                lights = 'failed'
+            discovery_time = time.time() - start
+
+            start = time.time()
+            found = utils.discover_lifx(lifxlan.LifxLAN())
+            labels_time = time.time() - start
+
+            gone = random.sample(bulbs, int(round(count * offline)))
+            for bulb in gone:
+                bulb.online = False
+
+            start = time.time()
+            for (light, bulb) in found:
+                try:
+                    light.get_power()
+                except Exception:
+                    pass
+            serial_time = time.time() - start
+
+            states = utils.LifxStates()
+            states.add_lights(found)
+
+            start = time.time()
+            states.poll()
+            shared_time = time.time() - start
+        finally:
+            simulator.stop()
+
+        print "%6d %8s %11.2fs %8d %11.2fs %8d %11.2fs %11.2fs" % (count, lights, discovery_time, len(found),
+                                                                     labels_time, len(gone), serial_time,
+                                                                     shared_time)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Simulate LIFX bulbs for testing and benchmarks")
+    parser.add_argument('mode', choices=['serve', 'benchmark'])
+    parser.add_argument('--bulbs', default='20', help="Number of bulbs, or a comma separated list to benchmark")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before each reply")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many more seconds before each reply")
+    parser.add_argument('--loss', type=float, default=0.0, help="Chance of each packet being lost")
+    parser.add_argument('--offline', type=float, default=0.0,
+                        help="Fraction of bulbs that never answer, or when benchmarking that stop answering after "
+                             "discovery")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on when serving")
+    options = parser.parse_args(args)
+
+    counts = [int(c) for c in options.bulbs.split(',')]
+
+    if options.mode == 'benchmark':
+        benchmark(counts, options.latency, options.jitter, options.loss, options.offline)
+        return
+
+    simulator = Simulator(make_bulbs(counts[0], offline=options.offline), options.host, LIFX_PORT,
+                          options.latency, options.jitter, options.loss).start()
+
+    print "Simulating %d bulbs on %s port %d, ctrl-C to stop" % (counts[0], options.host or '*', simulator.port)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
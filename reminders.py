@@ -10,6 +10,8 @@ from apiclient.discovery import build
 
 from kivy.logger import Logger
 
+import utils
+
 
 REMINDERS_FILE = 'reminders.dat'
 PICKLE_FILE = 'calendar.pkl'
@@ -18,13 +20,32 @@ USER_AGENT = 'reminders/v1.0'
 FLOW_SCOPE = 'https://www.googleapis.com/auth/calendar.readonly'
 
 
+class pooledHttp():
+    """Stands in for httplib2.Http, sending requests through the shared keep-alive pool in utils"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.timeout = pool.timeout
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                connection_type=None):
+        try:
+            (status, response_headers, content) = self.pool.request(uri, method, body, headers, redirections)
+        except IOError as e:
+            raise httplib2.HttpLib2Error(str(e))
+
+        response_headers['status'] = status
+
+        return httplib2.Response(response_headers), content
+
+
 class reminders():
 
     def __init__(self, settings):
 
         credentials = self._get_credentials(settings)
 
-        http = httplib2.Http()
+        http = pooledHttp(utils.http_pool)
         http = credentials.authorize(http)
 
         self.service = build(serviceName='calendar', version='v3', http=http, developerKey='YOUR_DEVELOPER_KEY')
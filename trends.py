@@ -0,0 +1,137 @@
+"""Rates of change and tendencies (rising, falling, steady) of logged readings over rolling time windows"""
+
+import collections
+
+# Rolling windows, as (field name suffix, seconds)
+WINDOWS = [('1h', 3600),
+           ('3h', 10800),
+           ('24h', 86400)]
+
+# Series tracked, with the rate of change (units per hour) below which they count as steady
+STEADY_RATES = {'pressure': 1.0 / 3,        # 1 mbar in 3 hours
+                'temp': 0.5,
+                'humidity': 2.0}
+
+
+class RollingTrend(object):
+    """Least squares slope of the samples from the last window seconds.
+
+    Keeps running sums of t, v, t*t and t*v, adding each new sample and subtracting those that drop out of
+    the window, so each sample costs O(1) however many the window holds."""
+
+    # Times are taken relative to an origin that's moved up every so often, keeping the sums small enough
+    # not to lose precision
+    REBASE_INTERVAL = 1000
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = collections.deque()
+        self.origin = None
+        self.adds_since_rebase = 0
+        self._reset_sums()
+
+    def add(self, t, v):
+        if self.origin is None:
+            self.origin = t
+
+        self.samples.append((t, v))
+        self._accumulate(t, v, 1)
+
+        while self.samples[0][0] < t - self.window:
+            (old_t, old_v) = self.samples.popleft()
+            self._accumulate(old_t, old_v, -1)
+
+        self.adds_since_rebase += 1
+        if self.adds_since_rebase >= self.REBASE_INTERVAL:
+            self._rebase()
+
+    def slope(self):
+        """Change per second, or None without enough samples to say"""
+        if self.n < 2:
+            return None
+
+        variance = self.n * self.sum_tt - self.sum_t * self.sum_t
+
+        if variance <= 0:
+            return None
+
+        return (self.n * self.sum_tv - self.sum_t * self.sum_v) / variance
+
+    def _accumulate(self, t, v, sign):
+        t -= self.origin
+
+        self.n += sign
+        self.sum_t += sign * t
+        self.sum_v += sign * v
+        self.sum_tt += sign * t * t
+        self.sum_tv += sign * t * v
+
+    def _reset_sums(self):
+        self.n = 0
+        self.sum_t = 0.0
+        self.sum_v = 0.0
+        self.sum_tt = 0.0
+        self.sum_tv = 0.0
+
+    def _rebase(self):
+        self.adds_since_rebase = 0
+        self.origin = self.samples[0][0]
+        self._reset_sums()
+
+        for (t, v) in self.samples:
+            self._accumulate(t, v, 1)
+
+
+class Trends(object):
+    """Tracks every series in STEADY_RATES over every window in WINDOWS"""
+
+    def __init__(self):
+        self.trends = {}
+
+        for name in STEADY_RATES:
+            for (suffix, seconds) in WINDOWS:
+                self.trends[(name, suffix)] = RollingTrend(seconds)
+
+    def add_reading(self, data_dict):
+        """data_dict is a database reading: {'datetime': 12345678, 'pressure': 1013, ...}"""
+        t = data_dict['datetime']
+
+        for name in STEADY_RATES:
+            value = data_dict.get(name)
+
+            if value is None:
+                continue
+
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+
+            for (suffix, seconds) in WINDOWS:
+                self.trends[(name, suffix)].add(t, value)
+
+    def conditions(self):
+        """Returns displayable fields for each series and window, e.g. pressure_rate_3h (mbar per hour),
+        pressure_change_3h (mbar over the 3 hours) and pressure_tendency_3h ('rising', 'falling' or 'steady')"""
+        fields = {}
+
+        for name in STEADY_RATES:
+            for (suffix, seconds) in WINDOWS:
+                slope = self.trends[(name, suffix)].slope()
+
+                if slope is None:
+                    continue
+
+                rate = slope * 3600
+
+                fields['%s_rate_%s' % (name, suffix)] = rate
+                fields['%s_change_%s' % (name, suffix)] = slope * seconds
+
+                if abs(rate) < STEADY_RATES[name]:
+                    fields['%s_tendency_%s' % (name, suffix)] = 'steady'
+                elif rate > 0:
+                    fields['%s_tendency_%s' % (name, suffix)] = 'rising'
+                else:
+                    fields['%s_tendency_%s' % (name, suffix)] = 'falling'
+
+        return fields
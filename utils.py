@@ -1,27 +1,60 @@
+import Queue
+import array
+import bisect
+import collections
+import colorsys
 import datetime
+import errno
+import httplib
 import json
+import mmap
 import os
 import pickle
 import pygame
-import sqlite3
+import select
+import socket
+import struct
 import syslog
+import tempfile
 import threading
 import time
-import urllib
+import urlparse
 
 from kivy.logger import Logger
 
+from history import Database, shared_database
+
 try:
     import astral
 except ImportError:
     pass
 
+try:
+    import lifxlan
+except ImportError:
+    lifxlan = None
+
 __author__ = 'nick'
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 CONDITIONS_FILE = BASE_DIR + '/conditions.p'
 SEMAPHORE_FILE = '/tmp/DHT22'
+READING_FILE = '/dev/shm/DHT22'
+
+LIFX_LAN_ON = [True, 1, "on", 65535]
+LIFX_LAN_OFF = [False, 0, "off"]
+
+# Longest to wait for a bulb to answer, and most bulbs to talk to at once
+LIFX_TIMEOUT = 1.5
+LIFX_WORKERS = 16
+
+# How often the shared light states are polled, and how long a state is trusted for
+LIFX_POLL_INTERVAL = 10
+LIFX_STATE_TTL = 60
+
+# Bulbs found by the last discovery, so the lights can be shown straight away at startup
+LIFX_CACHE_FILE = BASE_DIR + '/lifx_lights.json'
 
 def settings_path(path):
     """Returns path if it's an absolute path, otherwise adds base directory of source file to beginning"""
@@ -131,38 +164,851 @@ def areWePi():
     return (platform.machine() == 'armv7l')
 
 
+class SensorRecord(object):
+    """A single temperature and humidity reading shared between processes through a memory mapped file.
+
+    Layout is a sequence counter followed by the reading time, temperature and humidity. The writer makes the
+    counter odd while it changes the values and even again when it's done, so a reader can spot a half written
+    record and try again without any locking. Readers can tell a new reading has arrived from the counter alone."""
+
+    SEQUENCE = struct.Struct('<Q')
+    VALUES = struct.Struct('<3d')          # time, temperature, humidity
+    SIZE = SEQUENCE.size + VALUES.size
+    READ_ATTEMPTS = 10
+
+    def __init__(self, filename, writer=False):
+        self.filename = filename
+        self.writer = writer
+        self.map = None
+
+    def open(self):
+        """Maps the file, creating it if we're the writer. Returns False if there's nothing to map yet"""
+        if self.map is not None:
+            return True
+
+        try:
+            if self.writer:
+                if not os.path.exists(self.filename):
+                    with open(self.filename, 'wb') as f:
+                        f.write('\0' * self.SIZE)
+
+                with open(self.filename, 'r+b') as f:
+                    self.map = mmap.mmap(f.fileno(), self.SIZE)
+            else:
+                with open(self.filename, 'rb') as f:
+                    self.map = mmap.mmap(f.fileno(), self.SIZE, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError, mmap.error):
+            # Missing, or too short to hold a record
+            self.map = None
+            return False
+
+        return True
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def sequence(self):
+        """Returns the current sequence counter, or None if the file isn't there"""
+        if not self.open():
+            return None
+
+        return self.SEQUENCE.unpack_from(self.map, 0)[0]
+
+    def read(self):
+        """Returns (sequence, time, temperature, humidity), or None if no complete reading is available"""
+        if not self.open():
+            return None
+
+        for attempt in range(self.READ_ATTEMPTS):
+            sequence = self.SEQUENCE.unpack_from(self.map, 0)[0]
+
+            if sequence == 0:
+                # Nothing written yet
+                return None
+
+            if sequence & 1:
+                # Writer is part way through an update
+                continue
+
+            values = self.VALUES.unpack_from(self.map, self.SEQUENCE.size)
+
+            if self.SEQUENCE.unpack_from(self.map, 0)[0] == sequence:
+                return (sequence,) + values
+
+        return None
+
+    def write(self, temperature, humidity, reading_time=None):
+        if reading_time is None:
+            reading_time = time.time()
+
+        if not self.open():
+            raise IOError("Cannot map sensor record %s" % self.filename)
+
+        sequence = self.SEQUENCE.unpack_from(self.map, 0)[0]
+
+        self.SEQUENCE.pack_into(self.map, 0, sequence + 1)
+        self.VALUES.pack_into(self.map, self.SEQUENCE.size, reading_time, temperature, humidity)
+        self.SEQUENCE.pack_into(self.map, 0, sequence + 2)
+
+        # Writes through the map don't raise inotify events, so touch the file to wake up any FileWatcher
+        os.utime(self.filename, None)
+
+
+class FileWatcher(object):
+    """Waits for any of a set of files to change. Uses inotify on Linux and falls back to plain sleeping,
+    reporting every file as possibly changed, where inotify isn't available."""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')          # watch descriptor, mask, cookie, name length
+
+    def __init__(self, filenames=()):
+        self.filenames = set()
+        self.directories = {}               # watch descriptor -> directory
+        self.fd = None
+        self.libc = None
+
+        try:
+            import ctypes
+            import ctypes.util
+
+            try:
+                libc = ctypes.CDLL('libc.so.6', use_errno=True)
+            except OSError:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+
+            if fd >= 0:
+                self.libc = libc
+                self.fd = fd
+        except (ImportError, OSError, AttributeError):
+            pass
+
+        if self.fd is None:
+            Logger.info("FileWatcher: inotify not available, polling instead")
+
+        for filename in filenames:
+            self.add(filename)
+
+    def add(self, filename):
+        filename = os.path.abspath(filename)
+        self.filenames.add(filename)
+
+        if self.fd is None:
+            return
+
+        # Watch the directory so we also see the file being created or replaced
+        directory = os.path.dirname(filename)
+
+        if directory in self.directories.values():
+            return
+
+        wd = self.libc.inotify_add_watch(self.fd, directory, self.WATCH_MASK)
+
+        if wd < 0:
+            Logger.warning("FileWatcher: Cannot watch %s" % directory)
+            return
+
+        self.directories[wd] = directory
+
+    def wait(self, timeout):
+        """Blocks until a watched file changes or timeout seconds pass. Returns the set of files that changed"""
+        if self.fd is None:
+            time.sleep(timeout)
+            return set(self.filenames)
+
+        try:
+            (ready, _, _) = select.select([self.fd], [], [], timeout)
+        except select.error:
+            # Interrupted by a signal
+            return set()
+
+        if not ready:
+            return set()
+
+        buf = os.read(self.fd, 4096)
+        changed = set()
+        offset = 0
+
+        while offset + self.EVENT.size <= len(buf):
+            (wd, mask, cookie, length) = self.EVENT.unpack_from(buf, offset)
+            offset += self.EVENT.size
+
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                return set(self.filenames)
+
+            if wd in self.directories:
+                filename = os.path.join(self.directories[wd], name)
+
+                if filename in self.filenames:
+                    changed.add(filename)
+
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class RollingWindow(object):
+    """The last size samples of a series, held in an array backed ring buffer with running statistics.
+
+    Mean, minimum and maximum cost O(1) per sample (amortised, for minimum and maximum). The median and MAD
+    come from a sorted copy of the window that's kept up to date with bisect, so they cost O(log n) steps
+    plus the list insert and delete, which are memmoves done in C."""
+
+    def __init__(self, size):
+        self.size = size
+        self.samples = array.array('d', [0.0] * size)
+        self.count = 0                          # Samples added so far
+        self.total = 0.0
+        self.ordered = []
+        self.lows = collections.deque()         # (sample number, value), values increasing
+        self.highs = collections.deque()        # (sample number, value), values decreasing
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def add(self, value):
+        slot = self.count % self.size
+
+        if self.count >= self.size:
+            # Window full, so the oldest sample drops out
+            old = self.samples[slot]
+            self.total -= old
+            del self.ordered[bisect.bisect_left(self.ordered, old)]
+
+        self.samples[slot] = value
+        value = self.samples[slot]              # As stored, so it can be found again in ordered
+
+        self.total += value
+        bisect.insort(self.ordered, value)
+
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((self.count, value))
+
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((self.count, value))
+
+        self.count += 1
+
+        oldest = self.count - self.size
+        while self.lows[0][0] < oldest:
+            self.lows.popleft()
+        while self.highs[0][0] < oldest:
+            self.highs.popleft()
+
+    def values(self):
+        """Returns the samples, oldest first"""
+        if self.count <= self.size:
+            return self.samples[:self.count].tolist()
+
+        slot = self.count % self.size
+        return (self.samples[slot:] + self.samples[:slot]).tolist()
+
+    def mean(self):
+        if self.count == 0:
+            return None
+
+        return self.total / len(self)
+
+    def minimum(self):
+        if self.count == 0:
+            return None
+
+        return self.lows[0][1]
+
+    def maximum(self):
+        if self.count == 0:
+            return None
+
+        return self.highs[0][1]
+
+    def median(self):
+        n = len(self.ordered)
+
+        if n == 0:
+            return None
+
+        if n % 2:
+            return self.ordered[n // 2]
+
+        return (self.ordered[n // 2 - 1] + self.ordered[n // 2]) / 2.0
+
+    def mad(self):
+        """Median absolute deviation from the median"""
+        n = len(self.ordered)
+
+        if n == 0:
+            return None
+
+        median = self.median()
+
+        if n % 2:
+            return self._deviation(median, n // 2)
+
+        return (self._deviation(median, n // 2 - 1) + self._deviation(median, n // 2)) / 2.0
+
+    def _deviation(self, median, k):
+        """The k'th smallest (from 0) absolute deviation from median, in O(log n) steps.
+
+        Deviations grow moving outwards from the median in either direction, giving two sorted runs: below[i]
+        is median - ordered[split - 1 - i] and above[j] is ordered[split + j] - median. The k + 1 smallest
+        deviations are the first i of below and the first k + 1 - i of above for some i, found by bisecting."""
+        ordered = self.ordered
+        split = bisect.bisect_left(ordered, median)
+        below_count = split
+        above_count = len(ordered) - split
+        wanted = k + 1
+
+        low = max(0, wanted - above_count)
+        high = min(wanted, below_count)
+
+        while True:
+            i = (low + high) // 2
+            j = wanted - i
+
+            if i > 0 and j < above_count and median - ordered[split - i] > ordered[split + j] - median:
+                # Took too many from below
+                high = i - 1
+            elif j > 0 and i < below_count and ordered[split + j - 1] - median > median - ordered[split - 1 - i]:
+                # Took too few from below
+                low = i + 1
+            else:
+                break
+
+        deviations = []
+        if i > 0:
+            deviations.append(median - ordered[split - i])
+        if j > 0:
+            deviations.append(ordered[split + j - 1] - median)
+
+        return max(deviations)
+
+
+class SensorFilter(object):
+    """Smooths a noisy sensor channel.
+
+    A sample further from the median of the recent raw samples than outlier_limit scaled MADs (and at least
+    outlier_floor) is treated as a glitch and replaced by that median. The filtered value is the mean of the
+    accepted samples across the window."""
+
+    MAD_SCALE = 1.4826          # Makes the MAD comparable to a standard deviation for normally distributed noise
+    MIN_SAMPLES = 3
+
+    def __init__(self, size, outlier_limit, outlier_floor):
+        self.raw = RollingWindow(size)
+        self.accepted = RollingWindow(size)
+        self.outlier_limit = outlier_limit
+        self.outlier_floor = outlier_floor
+        self.rejected = 0
+
+    def add(self, value):
+        """Returns the new filtered value"""
+        self.raw.add(value)
+
+        if self.is_outlier(value):
+            self.rejected += 1
+            value = self.raw.median()
+
+        self.accepted.add(value)
+
+        return self.accepted.mean()
+
+    def is_outlier(self, value):
+        if len(self.raw) < self.MIN_SAMPLES:
+            return False
+
+        spread = max(self.outlier_limit * self.MAD_SCALE * self.raw.mad(), self.outlier_floor)
+
+        return abs(value - self.raw.median()) > spread
+
+    def value(self):
+        return self.accepted.mean()
+
+
 class DHT11(object):
-    """Periodically takes reads from a DHT11 type temperature and pressure sensor"""
+    """Periodically takes reads from a DHT11 type temperature and pressure sensor.
 
-    def __init__(self, conf_settings):
+    Readings come from a SensorRecord file written on this machine or, if a server is configured, are
+    streamed from a DHT22 network server."""
+
+    def __init__(self, conf_settings, start=True):
+        """start=False leaves refreshing to the caller, as SensorManager does"""
         self.threading_interval = int(conf_settings['update'])
         self.oldest_reading = int(conf_settings['oldest'])
 
+        window = int(conf_settings['window']) if 'window' in conf_settings else 5
+        outlier_limit = float(conf_settings['outlier_limit']) if 'outlier_limit' in conf_settings else 3.5
+        outlier_floor = float(conf_settings['outlier_floor']) if 'outlier_floor' in conf_settings else 1.0
+
+        self.filters = {'temperature': SensorFilter(window, outlier_limit, outlier_floor),
+                        'humidity': SensorFilter(window, outlier_limit, outlier_floor)}
+
+        # Filtered and raw readings, None if too old
         self.temperature = None
         self.humidity = None
+        self.raw_temperature = None
+        self.raw_humidity = None
+
+        # Most recent reading, however old
+        self.sequence = None
+        self.reading_time = None
+        self.latest_temperature = None
+        self.latest_humidity = None
+        self.filtered_temperature = None
+        self.filtered_humidity = None
+
+        self.record = None
+        self.legacy_file = None
+
+        if 'server' in conf_settings:
+            # Readings are pushed in through update_reading()
+            import DHT_client_twisted
+
+            port = int(conf_settings['port']) if 'port' in conf_settings else DHT_client_twisted.DHT_server.TWISTED_PORT
+            binary = conf_settings.get('framing') == 'binary'
+            sensor_id = int(conf_settings['sensor_id']) if 'sensor_id' in conf_settings else None
+
+            DHT_client_twisted.subscribe(self, conf_settings['server'], port, binary, sensor_id)
+        elif 'file' in conf_settings:
+            self.record = SensorRecord(conf_settings['file'])
+        else:
+            self.record = SensorRecord(READING_FILE)
+            self.legacy_file = SEMAPHORE_FILE
 
-        thread = threading.Thread(target=self.run, args=())
-        thread.daemon = True                            # Daemonize thread
-        thread.start()                                  # Start the execution
+        if start:
+            # Set up before the first refresh so that no new sample can slip in between the two
+            self.watcher = FileWatcher(self.watched_files())
+
+            thread = threading.Thread(target=self.run, args=())
+            thread.daemon = True                            # Daemonize thread
+            thread.start()                                  # Start the execution
+
+    def watched_files(self):
+        """Files whose changes mean there's a new reading"""
+        files = []
+
+        if self.record is not None:
+            files.append(self.record.filename)
+
+        if self.legacy_file is not None:
+            files.append(self.legacy_file)
+
+        return files
 
     def refresh(self):
-        self.temperature = None
-        self.humidity = None
+        if self.record is not None:
+            if self.record.open():
+                if self.record.sequence() != self.sequence:
+                    reading = self.record.read()
+
+                    if reading is not None:
+                        self.sequence = reading[0]
+                        self._new_sample(*reading[1:])
+            elif self.legacy_file is not None:
+                self._refresh_from_pickle()
+
+        self.update_current()
+
+    def update_reading(self, temperature, humidity, reading_time=None):
+        """Takes a new reading from a source that pushes them, such as the DHT22 network client"""
+        if reading_time is None:
+            reading_time = time.time()
+
+        self._new_sample(reading_time, temperature, humidity)
+        self.update_current()
+
+    def _new_sample(self, reading_time, temperature, humidity):
+        self.reading_time = reading_time
+        self.latest_temperature = temperature
+        self.latest_humidity = humidity
+
+        if temperature is not None:
+            self.filtered_temperature = self.filters['temperature'].add(temperature)
+
+        if humidity is not None:
+            self.filtered_humidity = self.filters['humidity'].add(humidity)
+
+    def update_current(self):
+        """Publishes the latest reading, unless it's older than oldest_reading"""
+        if self.reading_time is not None and time.time() - self.reading_time < self.oldest_reading:
+            self.temperature = self.filtered_temperature
+            self.humidity = self.filtered_humidity
+            self.raw_temperature = self.latest_temperature
+            self.raw_humidity = self.latest_humidity
+        else:
+            self.temperature = None
+            self.humidity = None
+            self.raw_temperature = None
+            self.raw_humidity = None
 
+    def _refresh_from_pickle(self):
+        """Sensor writers that predate SensorRecord leave a pickled dictionary in SEMAPHORE_FILE"""
         try:
-            sensor_reading = pickle.load(open(SEMAPHORE_FILE, 'rb'))
+            with open(self.legacy_file, 'rb') as f:
+                sensor_reading = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return
 
-            if time.time() - sensor_reading['time'] < self.oldest_reading:
-                self.temperature = sensor_reading['temperature']
-                self.humidity = sensor_reading['humidity']
-        except IOError:
-            pass
+        if sensor_reading['time'] != self.reading_time:
+            self._new_sample(sensor_reading['time'], sensor_reading['temperature'], sensor_reading['humidity'])
 
     def run(self):
         while True:
             self.refresh()
 
-            time.sleep(self.threading_interval)
+            # Woken early when the sensor writer produces a new sample. Still refresh on timeout so that
+            # readings get dropped once they're older than oldest_reading
+            self.watcher.wait(self.threading_interval)
+
+
+class SensorManager(object):
+    """Collects readings from any number of named sensors on one thread.
+
+    The [DHT11] section describes the default sensor. Others go in subsections of an optional [Sensors] section,
+    with scalars in [Sensors] acting as defaults for all of them, e.g.
+
+        [Sensors]
+            update = 10
+            oldest = 300
+            [[lounge]]
+                file = /dev/shm/lounge
+            [[garage]]
+                server = garagepi
+
+    File based sensors share a single inotify watcher; network sensors share the DHT22 client's reactor thread.
+    Readings are addressed as sensor.channel (e.g. lounge.temperature), or just channel for the default sensor."""
+
+    CHANNELS = ('temperature', 'humidity', 'raw_temperature', 'raw_humidity')
+
+    def __init__(self, settings):
+        self.sensors = collections.OrderedDict()
+        self.default = None
+
+        if 'DHT11' in settings:
+            self.default = DHT11(settings['DHT11'], start=False)
+
+        if 'Sensors' in settings:
+            for name in settings['Sensors'].sections:
+                self.sensors[name] = DHT11(accumulateLeaves(settings['Sensors'][name]), start=False)
+
+        all_sensors = self._all_sensors()
+
+        self.threading_interval = min([sensor.threading_interval for sensor in all_sensors] or [60])
+
+        self.watcher = FileWatcher()
+        for sensor in all_sensors:
+            for filename in sensor.watched_files():
+                self.watcher.add(filename)
+
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True                            # Daemonize thread
+        thread.start()                                  # Start the execution
+
+    # Default sensor readings, for callers that only know about one sensor
+    temperature = property(lambda self: self._default_reading('temperature'))
+    humidity = property(lambda self: self._default_reading('humidity'))
+    raw_temperature = property(lambda self: self._default_reading('raw_temperature'))
+    raw_humidity = property(lambda self: self._default_reading('raw_humidity'))
+
+    def reading(self, address):
+        """Returns the reading for 'sensor.channel' or 'channel', None if it's missing or out of date"""
+        if '.' in address:
+            (name, channel) = address.split('.', 1)
+            sensor = self.sensors.get(name)
+        else:
+            (sensor, channel) = (self.default, address)
+
+        if sensor is None or channel not in self.CHANNELS:
+            return None
+
+        return getattr(sensor, channel)
+
+    def refresh(self, changed=None):
+        """Refreshes sensors whose files are in changed, or all of them if changed is None"""
+        for sensor in self._all_sensors():
+            if changed is None or changed.intersection(map(os.path.abspath, sensor.watched_files())):
+                sensor.refresh()
+            else:
+                # No new sample, but it may have got too old
+                sensor.update_current()
+
+    def run(self):
+        changed = None
+
+        while True:
+            self.refresh(changed)
+
+            # Timeouts refresh everything, so each sensor's oldest limit still gets applied
+            changed = self.watcher.wait(self.threading_interval) or None
+
+    def _all_sensors(self):
+        if self.default is None:
+            return self.sensors.values()
+
+        return [self.default] + self.sensors.values()
+
+    def _default_reading(self, channel):
+        if self.default is None:
+            return None
+
+        return getattr(self.default, channel)
+
+class _PooledHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection that resolves its host through the pool's DNS cache"""
+
+    def __init__(self, pool, host, port, timeout):
+        httplib.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.pool = pool
+        self.idle_since = None
+
+    def connect(self):
+        self.sock = self.pool.create_socket(self.host, self.port, self.timeout)
+
+
+class _PooledHTTPSConnection(httplib.HTTPSConnection):
+    """HTTPS connection that resolves its host through the pool's DNS cache"""
+
+    def __init__(self, pool, host, port, timeout):
+        httplib.HTTPSConnection.__init__(self, host, port, timeout=timeout)
+        self.pool = pool
+        self.idle_since = None
+
+    def connect(self):
+        sock = self.pool.create_socket(self.host, self.port, self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class HttpPool(object):
+    """Shared HTTP client. Keeps connections alive between requests so repeated fetches from the same host
+    skip the TCP and TLS handshakes, caches DNS lookups and limits the number of requests in flight.
+
+    Optional [Http] settings: timeout, max_connections, dns_ttl, idle_timeout and a [[timeouts]]
+    subsection of per-host timeouts, e.g. api.wunderground.com = 20"""
+
+    # Safe to send again after a stale keep-alive connection fails, as the server may have acted on the first
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    # Redirects are followed like urllib2 and httplib2 do, up to MAX_REDIRECTS of them by default
+    MAX_REDIRECTS = 5
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+    def __init__(self, settings=None):
+        self.lock = threading.Lock()
+        self.idle = {}          # (scheme, host, port) -> list of idle connections
+        self.dns_cache = {}     # (host, port) -> (expiry time, address)
+
+        # Requests in flight, limited to max_connections. A count rather than a semaphore, so configure()
+        # can change the limit while requests are outstanding.
+        self.in_flight = 0
+        self.slot_free = threading.Condition(threading.Lock())
+
+        self.timeout = 10
+        self.max_connections = 4
+        self.dns_ttl = 300
+        self.idle_timeout = 30
+        self.host_timeouts = {}
+
+        self.configure(settings)
+
+    def configure(self, settings):
+        if settings is not None:
+            if 'timeout' in settings:
+                self.timeout = float(settings['timeout'])
+            if 'max_connections' in settings:
+                self.max_connections = int(settings['max_connections'])
+            if 'dns_ttl' in settings:
+                self.dns_ttl = int(settings['dns_ttl'])
+            if 'idle_timeout' in settings:
+                self.idle_timeout = int(settings['idle_timeout'])
+            if 'timeouts' in settings:
+                for host in settings['timeouts']:
+                    self.host_timeouts[host] = float(settings['timeouts'][host])
+
+        with self.slot_free:
+            # A bigger limit may let waiting requests through
+            self.slot_free.notify_all()
+
+    def request(self, url, method='GET', body=None, headers=None, redirections=MAX_REDIRECTS):
+        """Returns (status, headers, body), following up to redirections redirects. Raises IOError if the
+        request could not be completed or was redirected more times than that"""
+        for i in range(redirections + 1):
+            (status, response_headers, content) = self._request(url, method, body, headers)
+
+            if status not in self.REDIRECT_STATUSES or 'location' not in response_headers:
+                return status, response_headers, content
+
+            url = urlparse.urljoin(url, response_headers['location'])
+
+            # As browsers do, 303s and POSTs redirected by 301 or 302 become GETs of the new location
+            if status == 303 or (status in (301, 302) and method.upper() == 'POST'):
+                if method.upper() != 'HEAD':
+                    method = 'GET'
+
+                body = None
+
+                if headers is not None:
+                    headers = dict([(name, value) for (name, value) in headers.items()
+                                    if name.lower() not in ('content-type', 'content-length')])
+
+        raise IOError("%s %s: more than %d redirects" % (method, url, redirections))
+
+    def _request(self, url, method, body, headers):
+        parts = urlparse.urlsplit(url)
+
+        if parts.scheme == 'https':
+            port = parts.port or httplib.HTTPS_PORT
+        else:
+            port = parts.port or httplib.HTTP_PORT
+
+        key = (parts.scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        request_headers = {'Connection': 'keep-alive'}
+        if headers is not None:
+            request_headers.update(headers)
+
+        self._acquire_slot()
+        try:
+            connection = self._checkout(key)
+            reused = connection.sock is not None
+
+            try:
+                return self._send(key, connection, method, path, body, request_headers)
+            except (socket.error, httplib.HTTPException) as e:
+                connection.close()
+
+                if not reused or method.upper() not in self.IDEMPOTENT_METHODS:
+                    raise IOError("%s %s failed: %s" % (method, url, e))
+
+            # The server dropped an idle keep-alive connection, so the others are probably gone too
+            self._discard(key)
+            connection = self._checkout(key)
+
+            try:
+                return self._send(key, connection, method, path, body, request_headers)
+            except (socket.error, httplib.HTTPException) as e:
+                connection.close()
+                raise IOError("%s %s failed: %s" % (method, url, e))
+        finally:
+            self._release_slot()
+
+    def get(self, url):
+        """Returns the body of url. Raises IOError if the request could not be completed"""
+        return self.request(url)[2]
+
+    def create_socket(self, host, port, timeout):
+        try:
+            return socket.create_connection(self.resolve(host, port), timeout)
+        except socket.error:
+            # Address may have moved, look it up again next time
+            with self.lock:
+                self.dns_cache.pop((host, port), None)
+            raise
+
+    def resolve(self, host, port):
+        now = time.time()
+
+        with self.lock:
+            cached = self.dns_cache.get((host, port))
+
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][:2]
+
+        with self.lock:
+            self.dns_cache[(host, port)] = (now + self.dns_ttl, address)
+
+        return address
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+
+            self.idle = {}
+
+    def _acquire_slot(self):
+        with self.slot_free:
+            while self.in_flight >= self.max_connections:
+                self.slot_free.wait()
+
+            self.in_flight += 1
+
+    def _release_slot(self):
+        with self.slot_free:
+            self.in_flight -= 1
+            self.slot_free.notify()
+
+    def _send(self, key, connection, method, path, body, headers):
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        content = response.read()
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+
+        return response.status, dict(response.getheaders()), content
+
+    def _checkout(self, key):
+        now = time.time()
+
+        with self.lock:
+            connections = self.idle.get(key, [])
+
+            while connections:
+                connection = connections.pop()
+
+                if now - connection.idle_since < self.idle_timeout:
+                    return connection
+
+                connection.close()
+
+        (scheme, host, port) = key
+        timeout = self.host_timeouts.get(host, self.timeout)
+
+        if scheme == 'https':
+            return _PooledHTTPSConnection(self, host, port, timeout)
+
+        return _PooledHTTPConnection(self, host, port, timeout)
+
+    def _checkin(self, key, connection):
+        connection.idle_since = time.time()
+
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+
+    def _discard(self, key):
+        with self.lock:
+            connections = self.idle.pop(key, [])
+
+        for connection in connections:
+            connection.close()
+
+# Shared by everything that fetches over HTTP
+http_pool = HttpPool()
 
 class Wunderground(object):
     """Handles getting forecasts out of Weather Underground"""
@@ -170,6 +1016,11 @@ class Wunderground(object):
     def __init__(self, conf_settings, backlight):
         self.backlight = backlight
 
+        if 'Http' in conf_settings:
+            http_pool.configure(conf_settings['Http'])
+
+        self.http = http_pool
+
         self.api_key = conf_settings['Wunderground']['api_key']
 
         # URLs
@@ -182,6 +1033,11 @@ class Wunderground(object):
 
         self.conditions = self.forecast = None
 
+        # Logged history, for the conditions worked out from it, see derived
+        self.database = None
+        if 'Database' in conf_settings:
+            self.database = shared_database(conf_settings['Database'])
+
         self.update_interval = {}
         self.update_interval['background'] = int(conf_settings['Wunderground']['background_update'])
         self.update_interval['forecast'] =   int(conf_settings['Wunderground']['forecast_update'])
@@ -197,6 +1053,15 @@ class Wunderground(object):
         thread.daemon = True                            # Daemonize thread
         thread.start()                                  # Start the execution
 
+    @property
+    def derived(self):
+        """Conditions worked out from logged history, such as pressure_tendency_3h, for both front ends.
+        Uses the database, so only read it from the thread that created this."""
+        if self.database is None:
+            return {}
+
+        return self.database.trend_conditions()
+
     def updateRequired(self, update_type):
         if self.backlight is not None:
             if self.backlight.state is False:
@@ -287,13 +1152,13 @@ class Wunderground(object):
 
     def get_json(self, url):
         try:
-            response = urllib.urlopen(url)
+            response = self.http.get(url)
         except IOError:
             syslog.syslog(syslog.LOG_DEBUG, "get_json(%s) returned IOError" % url)
             return None
 
         try:
-            decoded_string = json.loads(response.read())
+            decoded_string = json.loads(response)
         except ValueError:
             syslog.syslog(syslog.LOG_DEBUG, "json.loads() returned ValueError")
             return None
@@ -306,19 +1171,99 @@ class Wunderground(object):
                                                                                  self.conditions['relative_humidity'],
                                                                                  self.conditions['precip_today_metric'])
 
+class HealthChecks(object):
+    """Checks the router, the weather API and the DHT22 feed on background threads, caching the results so a
+    screen can show them without waiting. Settings come from an optional [Health] section:
+
+        [Health]
+            interval = 15               # seconds between checks
+            timeout = 1                 # seconds to wait for a connection
+            router = 192.168.1.1
+            router_port = 53
+
+    Hosts are checked by opening a TCP connection. A refused connection still shows the host is there."""
+
+    def __init__(self, settings, indoor_sensor=None):
+        health = settings['Health'] if 'Health' in settings else {}
+
+        self.interval = float(health.get('interval', 15))
+        self.timeout = float(health.get('timeout', 1))
+
+        weather_url = urlparse.urlsplit(settings['Wunderground']['conditions_url'])
+        weather_port = weather_url.port or (443 if weather_url.scheme == 'https' else 80)
+
+        self.probes = {'router': (self._check_host, (health.get('router', '192.168.1.1'),
+                                                     int(health.get('router_port', 53)))),
+                       'weather': (self._check_host, (weather_url.hostname, weather_port)),
+                       'DHT22': (self._check_sensor, (indoor_sensor,))}
+
+        # name: (healthy, time checked)
+        self.results = {}
+        self.lock = threading.Lock()
+
+        # A thread each, so a slow check doesn't hold up the others
+        for name in self.probes:
+            thread = threading.Thread(target=self.run, args=(name,))
+            thread.daemon = True
+            thread.start()
+
+    def status(self, name):
+        """Returns (healthy, time checked), or (None, None) before the first check"""
+        with self.lock:
+            return self.results.get(name, (None, None))
+
+    def run(self, name):
+        (probe, args) = self.probes[name]
+
+        while True:
+            healthy = probe(*args)
+
+            with self.lock:
+                self.results[name] = (healthy, time.time())
+
+            time.sleep(self.interval)
+
+    def _check_host(self, host, port):
+        sock = None
+
+        try:
+            address = http_pool.resolve(host, port)
+            sock = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+        except socket.error as e:
+            return e.errno == errno.ECONNREFUSED
+        finally:
+            if sock is not None:
+                sock.close()
+
+        return True
+
+    def _check_sensor(self, indoor_sensor):
+        return indoor_sensor is not None and indoor_sensor.temperature is not None
+
+
 class almanac(object):
     def __init__(self, settings):
         a = astral.Astral()
         a.solar_depression = 'civil'
-        city = a[settings['location']]
+        self.city = a[settings['location']]
 
-        self.sun = city.sun(local=True)
+        self.sun = self.city.sun(local=True)
+
+    def sun_on(self, day):
+        """Sun times, as for sun, on a given date"""
+        return self.city.sun(date=day, local=True)
 
     def refresh(self):
         pass
 
 class backlight():
-    def __init__(self, settings):
+    # Ambient brightness is looked at again this often (seconds), and eased towards over AMBIENT_FADE seconds
+    AMBIENT_INTERVAL = 60
+    AMBIENT_FADE = 10
+
+    def __init__(self, settings, sun_almanac=None):
 
         self.on_command = settings['on_command']
         self.off_command = settings['off_command']
@@ -327,6 +1272,38 @@ class backlight():
         self.state = False   # True = backlight on, False = backlight off
         self.pi = areWePi()
 
+        # Write straight to the backlight driver where we can, using the commands if not
+        self.sysfs = None
+        if self.pi:
+            self.sysfs = self._open_sysfs(settings.get('sysfs_path'))
+
+        # Fades, in seconds, when waking on a touch and when switching off. Fades need sysfs; with the
+        # commands each change is made in one step.
+        self.wake_fade = float(settings.get('wake_fade', 0.5))
+        self.off_fade = float(settings.get('off_fade', 2.0))
+        self.fade_interval = 1.0 / float(settings.get('fade_rate', 30))   # Most writes per second
+
+        # Dims to night_brightness (a fraction of the chosen brightness) after sunset, easing in and out over
+        # twilight minutes centred on sunset and sunrise
+        self.night_brightness = float(settings.get('night_brightness', 1.0))
+        self.twilight = float(settings.get('twilight', 60)) * 60
+        self.sun_almanac = sun_almanac if self.night_brightness < 1.0 else None
+        self.sun_times = None
+        self._update_sun_times(datetime.date.today())
+
+        # Chosen on the brightness slider
+        self.user_brightness = int(settings.get('brightness', 255))
+
+        # Every power and brightness change is handed to a single fader thread as a (target brightness, fade
+        # seconds, power) request. A new request replaces one that hasn't been picked up yet and cancels
+        # the fade in progress.
+        self.brightness = None
+        self.powered = None
+        self.fade_request = None
+        self.fade_lock = threading.Lock()
+        self.fade_wanted = threading.Event()
+        self.fade_thread = None
+
         self.on_off = []
         for section in settings['OnTime'].sections:
             on_time = datetime.datetime.strptime(settings['OnTime'][section]['on'], '%H:%M')
@@ -338,6 +1315,13 @@ class backlight():
 
             self.on_off.append((on_time, off_time, weekday_only))
 
+        # OnTime windows as absolute (on, off) times, worked out once a day. An off time at or before the on
+        # time means the window runs past midnight.
+        self.schedule = []
+        self.schedule_expires = 0
+        self.scheduled_on = False
+        self.next_transition = 0
+
         # Reset the timer and switch the backlight on
         self.reset_timer()
 
@@ -349,28 +1333,84 @@ class backlight():
 
     def update_backlight(self):
         """Returns true if backlight switched off during call"""
-        timenow = datetime.datetime.now().time()
+        now = time.time()
 
-        for (on_time, off_time, weekday_only) in self.on_off:
-            if timenow > on_time.time() and timenow < off_time.time():
-                if self.state is False:
-                    if weekday_only:
-                        if (datetime.datetime.today().weekday() < 5):
-                            self.turnOnBacklight()
+        if now >= self.next_transition:
+            self._update_schedule(now)
 
-                    else:
-                        self.turnOnBacklight()
+        if self.scheduled_on:
+            if self.state is False:
+                self.turnOnBacklight()
 
-                return False
+            return False
 
         if self.state is True:
             if self.timeout > 0:  # negative value means always on
-                if (time.time() - self.timer) > self.timeout:
+                if (now - self.timer) > self.timeout:
                     self.turnOffBacklight()
                     return True
 
         return False
 
+    def next_change(self):
+        """Time of the next scheduled switch, timeout or schedule rebuild, so callers can sleep until then"""
+        times = [self.next_transition]
+
+        if self.state is True and self.timeout > 0 and not self.scheduled_on:
+            times.append(self.timer + self.timeout)
+
+        return min(times)
+
+    def _update_schedule(self, now):
+        if now >= self.schedule_expires:
+            self._build_schedule(now)
+
+        self.scheduled_on = False
+        self.next_transition = self.schedule_expires
+
+        for (on, off) in self.schedule:
+            if on <= now < off:
+                self.scheduled_on = True
+                self.next_transition = min(self.next_transition, off)
+            elif on > now:
+                self.next_transition = min(self.next_transition, on)
+
+    def _build_schedule(self, now):
+        today = datetime.date.fromtimestamp(now)
+        self.schedule = []
+
+        # Yesterday's windows can run on past midnight
+        for days in (-1, 0):
+            day = today + datetime.timedelta(days=days)
+
+            for (on_time, off_time, weekday_only) in self.on_off:
+                if weekday_only and day.weekday() >= 5:
+                    continue
+
+                on = datetime.datetime.combine(day, on_time.time())
+                off = datetime.datetime.combine(day, off_time.time())
+
+                if off <= on:
+                    off += datetime.timedelta(days=1)
+
+                self.schedule.append((time.mktime(on.timetuple()), time.mktime(off.timetuple())))
+
+        self.schedule.sort()
+
+        self._update_sun_times(today)
+
+        # Rebuilt at midnight
+        tomorrow = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time())
+        self.schedule_expires = time.mktime(tomorrow.timetuple())
+
+    def _update_sun_times(self, day):
+        """Sunrise and sunset on day, in seconds into the day, for the night dimming"""
+        if self.sun_almanac is None:
+            return
+
+        sun = self.sun_almanac.sun_on(day)
+        self.sun_times = tuple([self._seconds_into_day(sun[name]) for name in ('sunrise', 'sunset')])
+
     def handle_event(self, event):
         if event.type == pygame.MOUSEBUTTONDOWN:
             self.reset_timer()
@@ -379,19 +1419,176 @@ class backlight():
         self.state = True
         syslog.syslog(syslog.LOG_DEBUG, "Turning backlight on")
 
-        if self.pi:
-            os.system(self.on_command)
+        self._fade_to(self._ambient_brightness(time.time()), self.wake_fade, True)
 
     def turnOffBacklight(self):
         self.state = False
         syslog.syslog(syslog.LOG_DEBUG, "Turning backlight off")
 
-        if self.pi:
-            os.system(self.off_command)
+        self._fade_to(0, self.off_fade, False)
 
     def setBrightness(self, brightness):
-        if self.pi:
-            os.system(self.brightness_command % brightness)
+        """Returns straight away. While the brightness slider is dragged only the latest value gets written"""
+        self.user_brightness = int(brightness)
+
+        if self.state:
+            self._fade_to(self._ambient_brightness(time.time()), 0, True)
+
+    def _fade_to(self, brightness, fade, power):
+        if not self.pi:
+            return
+
+        with self.fade_lock:
+            self.fade_request = (brightness, fade, power)
+
+            if self.fade_thread is None:
+                self.fade_thread = threading.Thread(target=self._fader, args=())
+                self.fade_thread.daemon = True
+                self.fade_thread.start()
+
+        self.fade_wanted.set()
+
+    def _fader(self):
+        """Runs fades as a series of writes, at most one every fade_interval, and keeps the ambient
+        brightness up to date while the backlight is on"""
+        fade = None
+        next_ambient = 0
+        last_write = 0
+
+        while True:
+            if fade is not None:
+                timeout = self.fade_interval
+            elif self.powered and self.sun_times is not None:
+                timeout = max(0, next_ambient - time.time())
+            else:
+                timeout = None
+
+            self.fade_wanted.wait(timeout)
+
+            # New requests are held back too, so a burst of them ends up as one fade to the newest target
+            pause = last_write + self.fade_interval - time.time()
+            if pause > 0:
+                time.sleep(pause)
+
+            self.fade_wanted.clear()
+
+            with self.fade_lock:
+                request = self.fade_request
+                self.fade_request = None
+
+            now = time.time()
+
+            if request is not None:
+                (target, duration, power) = request
+
+                if power and not self.powered:
+                    self._write_power(True)
+                    self.powered = True
+
+                # Repeats of the target already being faded to carry on with that fade rather than restart it
+                if fade is None or fade[2:] != (target, duration, power):
+                    fade = (now, self.brightness, target, duration, power)
+
+                next_ambient = now + self.AMBIENT_INTERVAL
+            elif fade is None and self.powered and now >= next_ambient:
+                fade = (now, self.brightness, self._ambient_brightness(now), self.AMBIENT_FADE, True)
+                next_ambient = now + self.AMBIENT_INTERVAL
+
+            if fade is None:
+                continue
+
+            (start, start_brightness, target, duration, power) = fade
+
+            if start_brightness is None or self.sysfs is None or now >= start + duration:
+                brightness = target
+            else:
+                brightness = int(round(start_brightness + (target - start_brightness) * (now - start) / duration))
+
+            if brightness != self.brightness:
+                self._write_brightness(brightness)
+                self.brightness = brightness
+                last_write = now
+
+            if brightness == target:
+                fade = None
+
+                if not power and self.powered is not False:
+                    self._write_power(False)
+                    self.powered = False
+
+    def _ambient_brightness(self, now):
+        if self.sun_times is None:
+            return self.user_brightness
+
+        (sunrise, sunset) = self.sun_times
+        seconds = self._seconds_into_day(datetime.datetime.fromtimestamp(now))
+        half = self.twilight / 2
+
+        # 0 at night, 1 in the day and in between around sunrise and sunset
+        day = min(1.0, max(0.0, (seconds - sunrise + half) / self.twilight),
+                  max(0.0, (sunset + half - seconds) / self.twilight))
+
+        return int(round(self.user_brightness * (self.night_brightness + (1 - self.night_brightness) * day)))
+
+    @staticmethod
+    def _seconds_into_day(when):
+        return when.hour * 3600 + when.minute * 60 + when.second
+
+    def _open_sysfs(self, path):
+        """Opens bl_power and brightness under /sys/class/backlight, keeping them open for cheap writes"""
+        if path is None:
+            try:
+                devices = sorted(os.listdir('/sys/class/backlight'))
+            except OSError:
+                devices = []
+
+            if not devices:
+                return None
+
+            path = os.path.join('/sys/class/backlight', devices[0])
+
+        try:
+            with open(os.path.join(path, 'max_brightness')) as f:
+                max_brightness = int(f.read())
+
+            sysfs = {'bl_power': os.open(os.path.join(path, 'bl_power'), os.O_WRONLY),
+                     'brightness': os.open(os.path.join(path, 'brightness'), os.O_WRONLY),
+                     'max_brightness': max_brightness}
+        except (IOError, OSError, ValueError) as e:
+            syslog.syslog(syslog.LOG_INFO, "Cannot use backlight at %s (%s), using commands" % (path, e))
+            return None
+
+        syslog.syslog(syslog.LOG_INFO, "Using backlight at %s" % path)
+
+        return sysfs
+
+    def _write_sysfs(self, name, value):
+        """Returns False if the write failed"""
+        try:
+            os.lseek(self.sysfs[name], 0, os.SEEK_SET)
+            os.write(self.sysfs[name], "%d\n" % value)
+        except OSError as e:
+            # Use the commands from now on, so fades don't run a command per step
+            syslog.syslog(syslog.LOG_ERR, "Backlight %s write failed, using commands: %s" % (name, e))
+            self.sysfs = None
+            return False
+
+        return True
+
+    def _write_power(self, on):
+        if self.sysfs is not None:
+            # bl_power is 0 for on, anything else is a level of off
+            if self._write_sysfs('bl_power', 0 if on else 1):
+                return
+
+        os.system(self.on_command if on else self.off_command)
+
+    def _write_brightness(self, brightness):
+        if self.sysfs is not None:
+            if self._write_sysfs('brightness', max(0, min(brightness, self.sysfs['max_brightness']))):
+                return
+
+        os.system(self.brightness_command % brightness)
 
     def setTimeout(self, new_timeout):
         self.timeout = new_timeout
@@ -410,110 +1607,389 @@ class screenUpdate:
     def updateDone(self):
         self.last_updated = time.time()
 
-# Deal with the sqlite database
-class Database():
-    def __init__(self, database_settings):
-        if 'update' in database_settings:
-            self.update_interval = int(database_settings['update'])
-        else:
-            self.update_interval = None
 
-        self.last_updated = None
+def concurrent_map(function, items, timeout, workers):
+    """Calls function(item) for every item on up to workers threads, returning {item: result}. Items whose
+    call hasn't returned within timeout seconds, or raised an exception, map to None."""
+    items = list(items)
+    results = dict.fromkeys(items)
+    pending = Queue.Queue()
+    lock = threading.Lock()
+    finished = threading.Event()
+    remaining = [len(items)]
+
+    if not items:
+        return results
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                result = function(item)
+            except Exception as e:
+                # Not item itself, as turning a lifxlan light into a string asks the light for its details
+                syslog.syslog(syslog.LOG_DEBUG, "concurrent_map: %s raised %s" % (function.__name__, e))
+                result = None
+
+            with lock:
+                results[item] = result
+                remaining[0] -= 1
+
+                if remaining[0] == 0:
+                    finished.set()
+
+    for item in items:
+        pending.put(item)
 
-        self.db = sqlite3.connect(database_settings['filename'])
+    for i in range(min(workers, len(items))):
+        thread = threading.Thread(target=worker, args=())
+        thread.daemon = True
+        thread.start()
+
+    finished.wait(timeout)
+
+    # Late answers are dropped, so callers see one consistent set of results
+    with lock:
+        return dict(results)
+
+
+def _lifx_power_value(power):
+    if power in LIFX_LAN_OFF:
+        return False
+
+    if power in LIFX_LAN_ON:
+        return True
 
-        self.cursor = self.db.cursor()
+    return None
 
-        self.schema = [['datetime', 'REAL'],
-                       ['temp',     'REAL'],
-                       ['pressure', 'REAL'],
-                       ['humidity', 'REAL']]
 
-        # Do we need to create a new table?
+def lifx_set_power(lights, power, timeout=LIFX_TIMEOUT, workers=LIFX_WORKERS):
+    """Switches every light on or off at once, waiting for each to acknowledge.
+    Returns {light: True if it acknowledged, None if not}"""
+    def set_power(light):
+        light.set_power(power)
+        return True
+
+    return concurrent_map(set_power, lights, timeout, workers)
+
+
+def load_lifx_cache(filename=LIFX_CACHE_FILE):
+    """Returns the bulbs saved by save_lifx_cache(), [] if there aren't any"""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+
+_lifx_cache_lock = threading.Lock()
+
+def save_lifx_cache(bulbs, filename=LIFX_CACHE_FILE):
+    """bulbs is a list of {'mac': ..., 'ip': ..., 'label': ..., 'group': ...}. Safe to call from any thread"""
+    with _lifx_cache_lock:
+        temp_filename = None
+
         try:
-            self.cursor.execute("SELECT * from history LIMIT 1")
-        except sqlite3.OperationalError:
-            self.cursor.execute("CREATE TABLE history(%s)" % self._create_table_text())
-            self.db.commit()
-            syslog.syslog(syslog.LOG_INFO, "Created new data table in database %s" % database_settings['filename'])
+            (handle, temp_filename) = tempfile.mkstemp(prefix=os.path.basename(filename) + '.',
+                                                       dir=os.path.dirname(os.path.abspath(filename)))
+            os.fchmod(handle, 0644)
+
+            with os.fdopen(handle, 'w') as f:
+                json.dump(bulbs, f, indent=1)
+
+            # Replace in one go, so a crash can't leave half a file
+            os.rename(temp_filename, filename)
+        except (IOError, OSError) as e:
+            syslog.syslog(syslog.LOG_ERR, "Cannot save LIFX cache %s: %s" % (filename, e))
+
+            if temp_filename is not None and os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+
+def discover_lifx(lan, known=None, timeout=LIFX_TIMEOUT, workers=LIFX_WORKERS):
+    """Finds the bulbs on the LAN and asks them all at once for their labels and groups.
+
+    Returns a list of (lifxlan light, bulb) with bulb as stored by save_lifx_cache(). known is {mac: bulb}
+    from earlier, used for a bulb that answers discovery but not the label questions."""
+    if known is None:
+        known = {}
+
+    try:
+        lights = lan.get_lights()
+    except (IOError, getattr(lifxlan, 'WorkflowException', IOError)) as e:
+        # lifxlan gives up on the whole discovery if a bulb stops answering part way through
+        syslog.syslog(syslog.LOG_INFO, "LIFX discovery failed: %s" % e)
+        return []
+    identities = concurrent_map(_lifx_identity, lights, timeout, workers)
+    found = []
+
+    for light in lights:
+        mac = light.get_mac_addr()
+
+        if identities[light] is not None:
+            (label, group) = identities[light]
+        elif mac in known:
+            (label, group) = (known[mac]['label'], known[mac]['group'])
+        else:
+            # Try again next time
+            continue
 
-    def log_reading(self, weather_underground, indoor_sensor):
-        data_dict = {}
+        found.append((light, {'mac': mac, 'ip': light.get_ip_addr(), 'label': label, 'group': group}))
 
-        data_dict['humidity'] = indoor_sensor.humidity
-        data_dict['temp'] = indoor_sensor.temperature
-        data_dict['pressure'] = weather_underground.conditions['pressure_mb']
+    return found
 
-        self.write_reading(data_dict)
-        self.last_updated = time.time()
 
-    def write_reading(self, data_dict):
-        """Saves reading to the database.
-        Expects a dictionary in the format {'datetime': 12345678, 'level': float value,
-                                             'station': "Abingdon Lock', 'stream': "upstream"} """
+def _lifx_identity(light):
+    return light.get_label(), light.get_group_label()
 
-        # Time specified?
-        if not self._time_specified(data_dict):
-            data_dict['datetime'] = int(time.time())
 
-        field_list = ', '.join(data_dict.keys())
-        value_list = ('?,'*len(data_dict))[:-1]
-        value_tuple = tuple(data_dict.values())
+class LifxStates(object):
+    """Last known power and colour of every LIFX light, shared by the Lights screen and the button elements so
+    that neither has to ask a bulb while drawing. States older than ttl seconds count as unknown.
 
-        sql_string = "INSERT into history (%s) VALUES (%s)" % (field_list, value_list)
+    Lights are added with add_lights(), and set_lights() makes them match a discovery. poll() asks them for their state, all at once, and
+    set_power() switches them. Either way, callbacks given to subscribe() are told of every light whose
+    power changed, as callback(mac, power), on the thread that made the change."""
 
-        self.cursor.execute(sql_string, value_tuple)
-        self.db.commit()
+    def __init__(self, ttl=LIFX_STATE_TTL):
+        self.ttl = ttl
 
-        syslog.syslog(syslog.LOG_DEBUG, "Wrote to database (%d)" % data_dict['datetime'])
+        self.lock = threading.Lock()
+        self.lights = collections.OrderedDict()   # mac: lifxlan light
+        self.bulbs = {}                             # mac: bulb, as stored by save_lifx_cache()
+        self.states = {}                            # mac: (power, HSBK colour, time)
+        self.listeners = []
 
-    def updateDue(self):
-        if self.last_updated is None:
-            return True
+        # Only one discovery runs at a time, see discover()
+        self.discovery_lock = threading.Lock()
+        self.discoveries = 0
+        self.last_found = None
 
-        if self.update_interval is not None:
-            if (time.time() - self.update_interval) > self.last_updated:
-                return True
+        self.poll_thread = None
 
-        return False
+    def add_lights(self, found):
+        """found is a list of (lifxlan light, bulb), as returned by discover_lifx()"""
+        with self.lock:
+            for (light, bulb) in found:
+                if self.bulbs.get(bulb['mac']) != bulb:
+                    self.lights[bulb['mac']] = light
+                    self.bulbs[bulb['mac']] = bulb
 
-    def query(self, fields):
-        """Fields = list of fields to be returned by query, e.g. ['datetime', 'temp']
+    def set_lights(self, found):
+        """Like add_lights(), but also drops the lights that weren't found, so nothing waits on them any more"""
+        macs = set([bulb['mac'] for (light, bulb) in found])
 
-        returns a list in format: [[1234, 1235, ...], [26.1, 26.2, ...]]
-        """
-        sql_string = "SELECT %s FROM history" % ', '.join(fields)
+        with self.lock:
+            for mac in self.lights.keys():
+                if mac not in macs:
+                    del self.lights[mac]
+                    del self.bulbs[mac]
+                    self.states.pop(mac, None)
 
-        self.cursor.execute(sql_string)
-        rows = self.cursor.fetchall()
+        self.add_lights(found)
 
-        query_list = []
+    def discover(self, lan, known=None):
+        """Finds the lights with discover_lifx(), makes the table match with set_lights() and saves the cache.
+        known defaults to the lights already in the table. Returns what was found, or None if nothing was
+        while lights are known, which is more likely the network being down than every light gone.
 
-        for i in range(len(fields)):
+        A caller that arrives while a discovery is running waits for it and gets its result, rather than
+        scanning the network again."""
+        with self.lock:
+            discoveries = self.discoveries
 
-            new_list = []
+        with self.discovery_lock:
+            with self.lock:
+                if self.discoveries != discoveries:
+                    return self.last_found
 
-            for row in rows:
-                new_list.append(row[i])
+                if known is None:
+                    known = dict(self.bulbs)
 
-            query_list.append(new_list)
+            found = discover_lifx(lan, known)
 
-        return query_list
+            if found or not known:
+                self.set_lights(found)
+                save_lifx_cache([bulb for (light, bulb) in found])
+            else:
+                found = None
 
-    def _time_specified(self, data_dict):
-        if 'datetime' in data_dict:
-            if data_dict['datetime'] is not None:
-                return True
+            with self.lock:
+                self.discoveries += 1
+                self.last_found = found
 
-        return False
+        return found
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.listeners.append(callback)
+
+    def macs(self, label=None, group=None):
+        """Lights with the given label or in the given group, all of them if neither is given"""
+        with self.lock:
+            return [mac for (mac, bulb) in self.bulbs.items()
+                    if (label is None or bulb['label'] == label) and (group is None or bulb['group'] == group)]
+
+    def light(self, mac):
+        with self.lock:
+            return self.lights.get(mac)
+
+    def power(self, mac):
+        """True, False, or None if the light is offline or hasn't been heard from for ttl seconds"""
+        return self._state(mac)[0]
+
+    def color(self, mac):
+        """HSBK colour, None if unknown"""
+        return self._state(mac)[1]
+
+    def update(self, mac, power, color=None):
+        with self.lock:
+            old_power = self.states.get(mac, (None, None, 0))[0]
+            old_color = self.states.get(mac, (None, None, 0))[1]
+
+            self.states[mac] = (power, old_color if color is None else color, time.time())
+            listeners = list(self.listeners) if power != old_power else []
+
+        for callback in listeners:
+            callback(mac, power)
+
+    def poll(self, macs=None, max_age=0):
+        """Asks lights for their state, all at once. Lights polled in the last max_age seconds are skipped"""
+        now = time.time()
+
+        with self.lock:
+            if macs is None:
+                macs = self.lights.keys()
+
+            lights = dict([(self.lights[mac], mac) for mac in macs if mac in self.lights and
+                           now - self.states.get(mac, (None, None, 0))[2] >= max_age])
+
+        results = concurrent_map(_lifx_state, lights.keys(), LIFX_TIMEOUT, LIFX_WORKERS)
+
+        for (light, mac) in lights.items():
+            (power, color) = results[light] or (None, None)
+            self.update(mac, power, color)
+
+    def set_power(self, macs, power):
+        """Switches lights on or off at once. Returns {mac: True if it acknowledged, None if not}"""
+        with self.lock:
+            lights = dict([(self.lights[mac], mac) for mac in macs if mac in self.lights])
+
+        acknowledged = lifx_set_power(lights.keys(), power)
+
+        for (light, mac) in lights.items():
+            self.update(mac, power if acknowledged[light] else None)
+
+        return dict([(mac, acknowledged[light]) for (light, mac) in lights.items()])
+
+    def start_polling(self, interval=LIFX_POLL_INTERVAL):
+        """Polls on a background thread, for when nothing else is. Discovers the lights first if needed"""
+        with self.lock:
+            if self.poll_thread is not None:
+                return
+
+            self.poll_thread = threading.Thread(target=self.run, args=(interval,))
+            self.poll_thread.daemon = True
+            self.poll_thread.start()
+
+    def run(self, interval):
+        if not self.lights:
+            self.add_lights([(lifxlan.Light(bulb['mac'], bulb['ip']), bulb) for bulb in load_lifx_cache()])
+
+        # The cache may have lights that have since gone, and nothing else may ever look again
+        self.discover(lifxlan.LifxLAN())
+
+        while True:
+            # Anything polled recently by someone else is skipped
+            self.poll(max_age=interval)
+
+            time.sleep(interval)
+
+    def _state(self, mac):
+        with self.lock:
+            (power, color, updated) = self.states.get(mac, (None, None, 0))
+
+        if time.time() - updated > self.ttl:
+            return (None, None)
+
+        return (power, color)
+
+
+def _lifx_state(light):
+    """Power and colour in one round trip"""
+    color = light.get_color()
+
+    return _lifx_power_value(light.power_level), color
+
+
+# Shared by everything that shows or switches lights
+lifx_states = LifxStates()
+
+
+class lifxLight(object):
+    """A light, or a group of them, as seen through lifx_states, for the button elements. Never waits for the
+    network: power() and lifx_rgb_color() read the shared states and toggle() switches in the background."""
+
+    def __init__(self, light=None, group=None):
+        self.light_name = light
+        self.group_name = group
+
+        lifx_states.start_polling()
+
+    def macs(self):
+        # Looked up each time, as the lights may not have been discovered yet
+        return lifx_states.macs(label=self.light_name, group=self.group_name)
+
+    def subscribe(self, callback):
+        """callback() is called, on a background thread, whenever one of the lights changes"""
+        def changed(mac, power):
+            if mac in self.macs():
+                callback()
+
+        lifx_states.subscribe(changed)
+
+    def power(self):
+        """True if all the lights are on, False if any are off, None if none of them can be seen"""
+        powers = [lifx_states.power(mac) for mac in self.macs()]
+        known = [p for p in powers if p is not None]
+
+        if not known:
+            return None
+
+        return all(known)
+
+    def toggle(self):
+        """Returns the power the lights are being switched to"""
+        power = self.power()
+
+        if power is None:
+            return None
+
+        macs = self.macs()
+        power = not power
+
+        thread = threading.Thread(target=lifx_states.set_power, args=(macs, power))
+        thread.daemon = True
+        thread.start()
+
+        return power
+
+    def lifx_rgb_color(self):
+        """RGB of the light, or a list of them for a group, as taken by pygameButtonClass"""
+        colors = []
 
-    def _create_table_text(self):
-        text = ""
+        for mac in self.macs():
+            color = lifx_states.color(mac)
 
-        for i in range(0, len(self.schema)):
-            if i > 0:
-                text = text + ", "
+            if color is not None and lifx_states.power(mac):
+                (r, g, b) = colorsys.hsv_to_rgb(color[0] / 65535.0, color[1] / 65535.0, color[2] / 65535.0)
+                colors.append((int(r * 255), int(g * 255), int(b * 255)))
 
-            text = text + "%s %s" % (self.schema[i][0], self.schema[i][1])
+        if self.group_name is None:
+            return colors[0] if colors else (0, 0, 0)
 
-        return text
+        return colors
@@ -7,12 +7,16 @@ import sys
 import configobj
 import pygame
 import syslog
+import time
 
 import utils
 import elements
 
 SETTINGS_FILE = "weather.conf"
 
+# Longest sleep between passes while the backlight is off, which is how long a touch can take to wake it
+IDLE_WAIT = 0.1
+
 syslog.syslog(syslog.LOG_INFO, "Weather forecaster starting up...")
 
 if os.path.isfile(SETTINGS_FILE) is False:
@@ -32,7 +36,7 @@ sun_almanac = utils.almanac(settings['Almanac'])
 # Get pygame going
 pygame.init()
 
-backlight = utils.backlight(settings['Backlight'])
+backlight = utils.backlight(settings['Backlight'], sun_almanac)
 
 if settings['Screen'].as_bool('framebuffer'):
     # Check which frame buffer drivers are available
@@ -74,15 +78,16 @@ for section_name, function_name in element_types:
                 new_element = getattr(elements, function_name)(settings[section_name][day], sub_section, background_colour)
                 element_list.append(new_element)
     else:
-        for sub_section in settings[section_name].sections:
-            new_element = getattr(elements, function_name)(settings[section_name], sub_section, background_colour)
-            element_list.append(new_element)
+        if section_name in settings:
+            for sub_section in settings[section_name].sections:
+                new_element = getattr(elements, function_name)(settings[section_name], sub_section, background_colour)
+                element_list.append(new_element)
 
 weather_underground = utils.Wunderground(settings, backlight)
-indoor_sensor = utils.DHT11(settings['DHT11'])
+indoor_sensor = utils.SensorManager(settings)
 
 screen_update = utils.screenUpdate(settings['Screen'])
-database = utils.Database(settings['Database'])
+database = utils.shared_database(settings['Database'])
 
 input_events = utils.eventQueue()
 
@@ -90,6 +95,7 @@ while True:
 
     for event in input_events:
         if event.type == pygame.QUIT:
+            database.close()
             sys.exit()
 
         # We only care bout mouse-related events
@@ -134,4 +140,9 @@ while True:
     if database.updateDue():
         database.log_reading(weather_underground, indoor_sensor)
 
-    pygame.time.wait(10)
\ No newline at end of file
+    if backlight.state:
+        pygame.time.wait(10)
+    else:
+        # Nothing to draw, so only look for touches every IDLE_WAIT, or sooner if the backlight is due to change
+        wait = min(IDLE_WAIT, backlight.next_change() - time.time())
+        pygame.time.wait(int(max(wait, 0.01) * 1000))
@@ -43,12 +43,12 @@ LIFX_SCREEN = "lifx"
 REFRESH_INTERVAL_FOREGROUND = 10
 REFRESH_INTERVAL_BACKGROUND = 300
 
-LIFX_LAN_ON = [True, 1, "on", 65535]
-LIFX_LAN_OFF = [False, 0, "off"]
-
 BUTTON_RED_COLOR =   [1.0, 0.4, 0.4]
 BUTTON_GREEN_COLOR = [0.3, 0.6, 0.3]
 BUTTON_NEUTRAL_COLOR = [0, 0, 0]
+# How often to update health check colours when options screen in focus
+HEALTH_REFRESH_INTERVAL = 5
+
 BACKLIGHT_TIMES = [[10, '10 secs'], [20, '20 secs'], [30, '30 secs'], [45, '45 secs'],
                    [60, '1 min'],  [120, '2 mins'], [300, '5 mins'], [-1, 'Always on']]
 
@@ -61,19 +61,13 @@ class OptionsScreen(Screen):
     wunderground_color = ListProperty(BUTTON_NEUTRAL_COLOR)
     LIFX_color = ListProperty(BUTTON_NEUTRAL_COLOR)
 
-    def __init__(self, **kwargs):
+    def __init__(self, health_checks, **kwargs):
         super(OptionsScreen, self).__init__(**kwargs)
 
-        self.weather_screen_cache = None
-        self.bind(on_pre_enter=self.pre_enter_callback)
-
-    def weather_screen(self):
-        if self.weather_screen_cache is None:
-            for s in self.manager.screens:
-                if s.name == WEATHER_SCREEN:
-                    self.weather_screen_cache = s
+        self.health_checks = health_checks
 
-        return self.weather_screen_cache
+        self.bind(on_pre_enter=self.pre_enter_callback)
+        self.bind(on_leave=self.leave_callback)
 
     def backlight_brightness_change(self, value):
         self.manager.backlight.setBrightness(value)
@@ -86,30 +80,26 @@ class OptionsScreen(Screen):
     def pre_enter_callback(self, *args):
 
         self.update_logger()
-        self.update_wifi_status()
-        self.update_weather_status()
-        self.update_DHT_status()
+        self.update_health_status()
 
-        # TODO: Update every 15 seconds
+        Clock.schedule_interval(self.update_health_status, HEALTH_REFRESH_INTERVAL)
 
-    def update_wifi_status(self):
-        self.wifi_color = BUTTON_GREEN_COLOR if self.ping_host("192.168.1.1") else BUTTON_RED_COLOR
+    def leave_callback(self, *args):
+        Clock.unschedule(self.update_health_status)
 
-    def update_weather_status(self):
-        self.wunderground_color = BUTTON_GREEN_COLOR if self.ping_host("wunderground.com") else BUTTON_RED_COLOR
+    def update_health_status(self, *args):
+        """Shows the latest background health checks, which never block the UI"""
+        self.wifi_color = self.health_color('router')
+        self.wunderground_color = self.health_color('weather')
+        self.DHT22_color = self.health_color('DHT22')
 
-    def update_DHT_status(self):
-        s = self.weather_screen()
-        self.DHT22_color = BUTTON_RED_COLOR if s.indoor_sensor.temperature is None else BUTTON_GREEN_COLOR
+    def health_color(self, name):
+        (healthy, checked) = self.health_checks.status(name)
 
-    def ping_host(self, hostname):
-        response = os.system("ping -c 1 -W 1 " + hostname)
+        if healthy is None:
+            return BUTTON_NEUTRAL_COLOR
 
-        # and then check the response...
-        if response == 0:
-            return True
-        else:
-            return False
+        return BUTTON_GREEN_COLOR if healthy else BUTTON_RED_COLOR
 
     def update_logger(self):
         string = ""
@@ -148,23 +138,35 @@ class TimeChange:
 
 
 class Light:
-    def __init__(self, lifxlight, rooms):
+    def __init__(self, lifxlight, rooms, label=None, group=None):
+        """label and group are asked for if not given"""
         self.lifxlight = lifxlight
         self.rooms = rooms
 
-        self.label = self.lifxlight.get_label()
-        self.group = self.lifxlight.get_group_label()
+        self.mac = self.lifxlight.get_mac_addr()
+        self.label = self.lifxlight.get_label() if label is None else label
+        self.group = self.lifxlight.get_group_label() if group is None else group
 
         Logger.info("Lights: New light %s / %s" % (self.label, self.group))
 
+        self.refresh_in_process = False
+
         self.button = ToggleButton(text=self.label)
         self.button.bind(state=self.callback)
 
+    def bulb(self):
+        """As stored in the LIFX cache"""
+        return {'mac': self.mac, 'ip': self.lifxlight.get_ip_addr(), 'label': self.label, 'group': self.group}
+
     def button_state(self):
         return False if self.button.state == 'normal' else True
 
     def callback(self, instance, value):
         """Ensures that light is set to same state as button"""
+        if self.refresh_in_process:
+            # Button is showing the light's state, not a press
+            return
+
         button_state = False if value == 'normal' else True
 
         light_state = self.get_state()
@@ -174,37 +176,28 @@ class Light:
             if light_state is None:
                 return
 
-            self.lifxlight.set_power(button_state)
+            thread = threading.Thread(target=utils.lifx_states.set_power, args=([self.mac], button_state))
+            thread.daemon = True
+            thread.start()
+
             self.rooms.refresh()
 
         Logger.debug("Lights: Light is %s, value is %s, get_power is %s" % (self.label, value, self.get_state()))
 
     def refresh_light(self):
-        light_state = self.get_state()
+        self.show_state(self.get_state())
 
-        if light_state is True:
-            self.button.state = 'down'
+    def show_state(self, light_state):
+        """Sets the button to light_state without switching the light"""
+        self.refresh_in_process = True
 
-        if light_state is False:
-            self.button.state = 'normal'
+        self.button.state = 'down' if light_state is True else 'normal'
 
-        if light_state is None:
-            self.button.state = 'normal'
+        self.refresh_in_process = False
 
     def get_state(self):
-        try:
-            power = self.lifxlight.get_power()
-        except IOError:
-            # Light is offline
-            return None
-
-        if power in LIFX_LAN_OFF:
-            return False
-
-        if power in LIFX_LAN_ON:
-            return True
-
-        return None
+        """From the shared states, so never waits for the light"""
+        return utils.lifx_states.power(self.mac)
 
 
 class Rooms:
@@ -218,7 +211,7 @@ class Rooms:
                 room.add_light(light)
                 return None
 
-        new_room = Room(light.group)
+        new_room = Room(light.group, self)
 
         self.room_list.append(new_room)
 
@@ -226,6 +219,18 @@ class Rooms:
 
         return new_room.room_button
 
+    def remove_light(self, light):
+        """Returns the room's button if that was the last light in it, so the room has gone too"""
+        for room in self.room_list:
+            if light in room.light_list:
+                room.light_list.remove(light)
+
+                if len(room.light_list) == 0:
+                    self.room_list.remove(room)
+                    return room.room_button
+
+        return None
+
     def refresh(self):
         for room in self.room_list:
             room.refresh()
@@ -240,9 +245,10 @@ class Rooms:
 
 
 class Room:
-    def __init__(self, label):
+    def __init__(self, label, rooms):
         self.light_list = []
         self.label = label
+        self.rooms = rooms
 
         self.refresh_in_process = False
 
@@ -279,8 +285,32 @@ class Room:
             # User did not press the button
             return
 
-        for light in self.light_list:
-            light.button.state = value
+        power = False if value == 'normal' else True
+        lights = list(self.light_list)
+
+        # Show the change straight away, then switch all the lights at once in the background
+        for light in lights:
+            light.show_state(power)
+
+        thread = threading.Thread(target=self.switch_lights_thread, args=(lights, power))
+        thread.daemon = True
+        thread.start()
+
+    def switch_lights_thread(self, lights, power):
+        acknowledged = utils.lifx_states.set_power([light.mac for light in lights], power)
+
+        for light in lights:
+            if not acknowledged.get(light.mac):
+                Logger.warning("Lights: %s did not acknowledge switching %s" % (light.label, 'on' if power else 'off'))
+
+        Clock.schedule_once(lambda dt: self.lights_switched(lights))
+
+    def lights_switched(self, lights):
+        """Shows the lights as they now are, then works out every room's state once"""
+        for light in lights:
+            light.refresh_light()
+
+        self.rooms.refresh()
 
 
 class LifxScreen(Screen):
@@ -291,6 +321,7 @@ class LifxScreen(Screen):
         self.rooms = None
 
         self.refresh_clock = None
+        self.show_states_pending = False
 
         # Thread management
         self.refresh_thread = None
@@ -304,6 +335,12 @@ class LifxScreen(Screen):
 
         self.lan = lifxlan.LifxLAN()
 
+        # Show the lights found last time straight away, then check them in the background
+        self.update_lights([(lifxlan.Light(bulb['mac'], bulb['ip']), bulb) for bulb in utils.load_lifx_cache()])
+
+        # Lights may also be switched by the button elements on the weather screen
+        utils.lifx_states.subscribe(self.light_changed)
+
         self.refresh_lights()
 
         self.set_schedule_interval(REFRESH_INTERVAL_BACKGROUND)
@@ -328,7 +365,8 @@ class LifxScreen(Screen):
                 self.ids['refresh_button'].state = 'normal'
             else:
                 self.ids['refresh_button'].state = 'down'
-        else:
+        elif value == 'down':
+            # Pressed, rather than put back by the end of a refresh
             self.refresh_lights()
 
     def refresh_slot(self, dt):
@@ -346,49 +384,112 @@ class LifxScreen(Screen):
         if self.refresh_thread_running():
             return
 
-        self.refresh_thread = threading.Thread(target=self.find_lights_thread)
+        known = dict([(light.mac, light.bulb()) for light in self.lights])
+
+        self.refresh_thread_finishing = False
+        self.refresh_thread = threading.Thread(target=self.find_lights_thread, args=(known,))
         self.refresh_thread.start()
 
-    def find_lights_thread(self):
+        self.ids['refresh_button'].state = 'down'
+
+    def find_lights_thread(self, known):
+        """Only talks to the network. Widgets are changed on the UI thread, by lights_found()"""
         Logger.debug("Lights: Find lights thread started")
 
-        self.refresh_thread_finishing = False
-        self.ids['refresh_button'].state = 'down'
+        # Shared with the polling thread, so they don't both scan the network at startup
+        found = utils.lifx_states.discover(self.lan, known)
 
-        if self.lights is not None:
-            for light, button in self.lights:
-                self.ids['light_layout'].remove_widget(button)
+        # Bail out?
+        if self.stop_refresh_thread:
+            return
 
-        if self.rooms is not None:
-            for room in self.rooms.room_list:
-                self.ids['group_layout'].remove_widget(room.room_button)
+        if found is None:
+            Logger.warning("Lights: Discovery found no lights, keeping the %d known" % len(known))
 
-        self.lights = []
-        self.rooms = Rooms()
+        macs = known.keys() if found is None else [bulb['mac'] for (lifxlight, bulb) in found]
+        utils.lifx_states.poll(macs)
 
-        for l in self.lan.get_lights():
-            # Bail out?
-            if self.stop_refresh_thread:
-                return
+        Clock.schedule_once(lambda dt: self.lights_found(found))
+
+        Logger.debug("Lights: Find lights thread finished")
+
+    def lights_found(self, found):
+        """Shows the results of discovery, if there are any, and the lights' states in one go"""
+        if found is not None:
+            self.update_lights(found)
+
+        self.show_states(0)
+
+        self.refresh_thread_finishing = True
+        self.ids['refresh_button'].state = 'normal'
+
+    def update_lights(self, found):
+        """found is a list of (lifxlan light, bulb). Changes only the buttons that need it: new lights are
+        added, ones that have gone are removed, and ones whose label or group has changed are updated where
+        they are. Must be called on the UI thread."""
+        if self.lights is None:
+            self.lights = []
+            self.rooms = Rooms()
+
+        utils.lifx_states.add_lights(found)
+
+        wanted = dict([(bulb['mac'], (lifxlight, bulb)) for (lifxlight, bulb) in found])
+
+        for light in list(self.lights):
+            if light.mac not in wanted:
+                Logger.info("Lights: Removing light %s / %s" % (light.label, light.group))
+
+                self.ids['light_layout'].remove_widget(light.button)
+                self.lights.remove(light)
+
+                self.remove_from_room(light)
+                continue
+
+            (lifxlight, bulb) = wanted[light.mac]
+
+            if light.bulb() == bulb:
+                continue
+
+            Logger.info("Lights: Light %s / %s is now %s / %s" % (light.label, light.group, bulb['label'],
+                                                                  bulb['group']))
+
+            # Picks up a new address
+            light.lifxlight = lifxlight
+
+            if light.label != bulb['label']:
+                light.label = bulb['label']
+                light.button.text = light.label
+
+            if light.group != bulb['group']:
+                self.remove_from_room(light)
+                light.group = bulb['group']
+                self.add_to_room(light)
 
-            new_light = Light(l, self.rooms)
+        kept = set([light.mac for light in self.lights])
+
+        for (lifxlight, bulb) in found:
+            if bulb['mac'] in kept:
+                continue
+
+            new_light = Light(lifxlight, self.rooms, bulb['label'], bulb['group'])
 
             self.ids['light_layout'].add_widget(new_light.button)
 
             self.lights.append(new_light)
 
-            new_light.refresh_light()
-
-            new_room_button = self.rooms.add_room(new_light)
-            if new_room_button is not None:
-                self.ids['group_layout'].add_widget(new_room_button)
+            self.add_to_room(new_light)
 
         self.rooms.refresh()
 
-        self.refresh_thread_finishing = True
-        self.ids['refresh_button'].state = 'normal'
+    def add_to_room(self, light):
+        new_room_button = self.rooms.add_room(light)
+        if new_room_button is not None:
+            self.ids['group_layout'].add_widget(new_room_button)
 
-        Logger.debug("Lights: Find lights thread finished")
+    def remove_from_room(self, light):
+        empty_room_button = self.rooms.remove_light(light)
+        if empty_room_button is not None:
+            self.ids['group_layout'].remove_widget(empty_room_button)
 
     def refresh(self):
         if self.lights is None:
@@ -404,17 +505,35 @@ class LifxScreen(Screen):
     def refresh_lights_thread(self):
         Logger.debug("LightS: Refresh lights thread started")
 
-        for light in self.lights:
-            if self.stop_refresh_thread:
-                # Bail out
-                return
+        # Ask every light at once, then show all the answers together
+        utils.lifx_states.poll([light.mac for light in self.lights])
 
-            light.refresh_light()
+        if self.stop_refresh_thread:
+            # Bail out
+            return
 
-        self.rooms.refresh()
+        self.schedule_show_states()
 
         Logger.debug("Lights: Refresh lights thread finished")
 
+    def light_changed(self, mac, power):
+        """Called by utils.lifx_states, on whichever thread changed the light"""
+        self.schedule_show_states()
+
+    def schedule_show_states(self):
+        if not self.show_states_pending:
+            self.show_states_pending = True
+            Clock.schedule_once(self.show_states)
+
+    def show_states(self, dt):
+        """Shows every light's latest state, on the UI thread"""
+        self.show_states_pending = False
+
+        for light in self.lights:
+            light.refresh_light()
+
+        self.rooms.refresh()
+
     def on_stop(self):
         if self.refresh_thread_running():
             self.stop_refresh_thread = True
@@ -422,7 +541,7 @@ class LifxScreen(Screen):
 
 
 class WeatherScreen(Screen):
-    def __init__(self, settings, **kwargs):
+    def __init__(self, settings, sun_almanac, **kwargs):
         super(WeatherScreen, self).__init__(**kwargs)
 
         self.settings = settings
@@ -446,9 +565,9 @@ class WeatherScreen(Screen):
                                                                        self.background_colour)
                         self.element_list.append(new_element)
 
-        self.sun_almanac = utils.almanac(settings['Almanac'])
+        self.sun_almanac = sun_almanac
         self.weather_underground = utils.Wunderground(settings, None)
-        self.indoor_sensor = utils.DHT11(settings['DHT11'])
+        self.indoor_sensor = utils.SensorManager(settings)
 
         self.image_size = utils.listToTuple(self.settings['Screen']['size'])
 
@@ -536,10 +655,10 @@ class WeatherScreen(Screen):
 class BacklightScreenManager(ScreenManager):
     """Adds backlight management to the ScreenManager class"""
 
-    def __init__(self, settings, **kwargs):
+    def __init__(self, settings, sun_almanac, **kwargs):
         super(BacklightScreenManager, self).__init__(**kwargs)
 
-        self.backlight = utils.backlight(settings['Backlight'])
+        self.backlight = utils.backlight(settings['Backlight'], sun_almanac)
         self.time_tracker = TimeChange(settings)
 
         self.bind(on_touch_down=self.screen_press)
@@ -576,11 +695,17 @@ class WeatherApp(App):
         if 'debug' in settings['General']:
             Logger.setLevel(kivy.logger.logging.DEBUG)
 
-        root = BacklightScreenManager(settings)
+        # Shared by the weather screen's sun elements and the backlight's night dimming
+        sun_almanac = utils.almanac(settings['Almanac'])
+
+        root = BacklightScreenManager(settings, sun_almanac)
         root.transition = kivy.uix.screenmanager.SlideTransition()
 
-        root.add_widget(WeatherScreen(settings, name=WEATHER_SCREEN))
-        root.add_widget(OptionsScreen(name=OPTIONS_SCREEN))
+        weather_screen = WeatherScreen(settings, sun_almanac, name=WEATHER_SCREEN)
+        root.add_widget(weather_screen)
+
+        health_checks = utils.HealthChecks(settings, weather_screen.indoor_sensor)
+        root.add_widget(OptionsScreen(health_checks, name=OPTIONS_SCREEN))
 
         self.lifx_screen = LifxScreen(settings, name=LIFX_SCREEN)
         root.add_widget(self.lifx_screen)